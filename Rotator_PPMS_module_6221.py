@@ -1,166 +1,257 @@
-import pyvisa
 import time
-import pandas as pd
-import matplotlib.pyplot as plt
+import contextlib
 import os,sys
 import numpy as np
 #from MultiPyVu import MultiVuClient as mvc
-from matplotlib.animation import FuncAnimation
-from labdrivers.quantumdesign import qdinstrument
+import sr830_range
+import acquisition
+import live_plot
+import data_writer
+import sample_store
+import settle
+import async_instruments
+import profiling
+import harmonic_fit
+import catalog as run_catalog
+import zigzag as zigzag_sweep
+import demod
+import publisher
+import telemetry as telemetry_sampler
 
-os.chdir(sys.path[0])
+FREQUENCY = 1713 # Hz, 6221 AC current
+PHASES = {1:0,2:90} # degree, lock-in reference phase per harmonic
 
 class AHE():
-    def __init__(self,path_name,file_name,temperature0,field0,scan_rate,harm,set_temp,waiting_time,pos1,pos2):
+    def __init__(self,path_name,file_name,temperature0,field0,scan_rate,harm,set_temp,waiting_time,pos1,pos2,buffered=False,threaded=False,sample_rate=64,headless=False,session=None,defer=None,fit=False,orders=3,stop_tolerance=None,catalog=True,checkpoint=None,autorange=False,zigzag=False,cycles=1,digitizer=None,harmonics=(1,2,3),bandwidth=10,publish=None,telemetry=None):
+        # run parameters for the catalog
+        self.params = {k:v for k,v in locals().items() if k not in ('self','ppms','session','defer','catalog','checkpoint','publish','digitizer')}
         self.path_name = path_name
+        # times every instrument call and wait of this run
+        self.profiler = profiling.Profiler()
         # ---------------------------------------------------------
         # ---------------------------------------------------------
-        self.file_name = file_name+'temperature_{}K_field_{}Oe_{}harm.csv'.format(temperature0,field0,harm)
-        # Initialize the VISA resource manager
-        rm = pyvisa.ResourceManager()
+        self.file_name = self.output_name(file_name,temperature0,field0,harm)
+        # runs are registered in <path_name>/catalog.sqlite unless catalog=False
+        self.catalog = run_catalog.open_catalog(catalog,path_name)
+        # samples and run status go to a local stream for live viewers (see publisher.py)
+        self.publisher = publisher.open_publisher(publish)
+        if self.publisher is not None:
+            self.publisher.run = self.file_name
+        # Initialize the VISA resource manager (or reuse the open ones of a session)
+        self.session = session
+        if session is not None:
+            rm = session
+        else:
+            import pyvisa
+            rm = pyvisa.ResourceManager()
         
         # Open connections
         #self.k2901 = rm.open_resource('GPIB0::17::INSTR') #B2901A
-        self.k6221 = rm.open_resource('GPIB1::12::INSTR') #k6221
-        self.sr830 = rm.open_resource('GPIB0::8::INSTR')  #sr830
+        self.k6221 = self.profiler.wrap(rm.open_resource('GPIB1::12::INSTR'),'k6221') #k6221
+        self.sr830 = self.profiler.wrap(rm.open_resource('GPIB0::8::INSTR'),'sr830')  #sr830
+        # with a digitizer (anything with start() and fetch() -> (t, v, i) of raw
+        # samples of the voltage and the 6221 current) the lock-in is done in
+        # software (see demod.py), locked to the current and at the reference phases
+        # the SR830 would use: every harmonic in `harmonics` is measured in the same
+        # rotation, `harm` is the one plotted and fitted
+        self.digitizer = self.profiler.wrap(digitizer,'digitizer') if digitizer is not None else None
+        self.harmonics = list(harmonics)
+        self.bandwidth = bandwidth
         self.harm = harm
-        self.set_config()
         self.field0 = field0
 
         print('start to connect DynaCool')
-        self.ppms=qdinstrument.QdInstrument('DynaCool','192.168.0.4')
+        if session is not None:
+            self.ppms = session.ppms
+        else:
+            from labdrivers.quantumdesign import qdinstrument
+            self.ppms=qdinstrument.QdInstrument('DynaCool','192.168.0.4')
+        self.ppms = self.profiler.wrap(self.ppms,'ppms')
         print('connection established')
 
+        # configure the instruments while the temperature settles
+        jobs = []
+        if session is None or session.needs_config('rotator',(harm,autorange)):
+            jobs.append(async_instruments.configure(self.config_commands()))
         if set_temp:
-            self.set_temp(temperature0)
-            for i in range(waiting_time):
-                time.sleep(1)
-                print('waiting, remaining time {}'.format(waiting_time-i))
-        
+            jobs.append(async_instruments.on_ppms(self.set_temp,temperature0,hold=waiting_time))
+        async_instruments.run(*jobs)
+        # an interrupted run (see checkpoint.py) continues its leg from the last saved angle
+        self.checkpoint = checkpoint
+        self.resume = checkpoint.resume() if checkpoint is not None else {}
+        if checkpoint is not None and set_temp:
+            checkpoint.settled(temperature0)
+
+        # with autorange the SR830 sensitivity follows the signal (see sr830_range.py),
+        # samples are taken at the rate the time constant resolves and each one is
+        # saved with its full scale
+        self.autorange = sr830_range.AutoRange(self.sr830) if autorange and digitizer is None else None
+        if self.autorange is not None:
+            sample_rate = min(sample_rate,self.autorange.sample_rate())
+
+        # with zigzag the scan runs pos1 -> pos2 -> pos1 for `cycles` cycles in one
+        # continuous acquisition, every point tagged with direction and cycle
+        legs = zigzag_sweep.legs(pos1,pos2,cycles if zigzag else 1)
+        first = self.resume.get('leg',0)
+        if 'position' in self.resume:
+            legs[first] = (self.resume['position'],legs[first][1])
+        self.sweep = zigzag_sweep.SweepLog(first) if zigzag else None
+
+        # with telemetry temperature, field and chamber status are read in the
+        # background (every telemetry s) and saved with every point
+        self.telemetry = telemetry_sampler.open_telemetry(telemetry,self.ppms,axes=('position',))
 
-        self.positions = []
-        self.voltages = []
-        self.voltages_y = []
+        # Points of both legs are streamed to disk as they are acquired
+        self.store = sample_store.SampleStore(maxlen=sample_store.MAXLEN,dtype=sample_store.sample_dtype(
+            ['t','position','x','y']+(['sensitivity'] if self.autorange is not None else [])
+            +(['direction','cycle'] if zigzag else [])+(self.telemetry.channels if self.telemetry is not None else [])))
+        self.writer = data_writer.StreamWriter(self.path_name + self.file_name,['position (degree)','voltage_x (V)','voltage_y (V)']
+                                               + (['sensitivity (V)'] if self.autorange is not None else [])
+                                               + (['direction','cycle'] if zigzag else [])
+                                               + ([f'voltage_{c}_{n}w (V)' for n in self.harmonics for c in 'xy']
+                                                  if digitizer is not None else [])
+                                               + ([telemetry_sampler.COLUMNS[c] for c in self.telemetry.channels]
+                                                  if self.telemetry is not None else []),
+                                               resume_rows=self.resume.get('rows'))
 
         # Prepare for plotting
-        self.animating = True
-        self.fig = plt.figure(figsize=(10,4))
-        self.ax1 = self.fig.add_axes([0.15,0.2,0.3,0.7])
-        self.ax2 = self.fig.add_axes([0.65,0.2,0.3,0.7])
-        plt.subplots_adjust(left=0.2,right=0.9,top=0.9,bottom=0.2)
-        self.ax1.set_xlabel("Field (Oe)")
-        self.ax1.set_ylabel("Voltage_x (V)")
-        self.ax2.set_xlabel("Field (Oe)")
-        self.ax2.set_ylabel("Voltage_y (V)")
+        self.plotter = live_plot.make_plotter(headless,"Position (degree)",["Voltage_x (V)","Voltage_y (V)"],
+                                              [[0.15,0.2,0.3,0.7],[0.65,0.2,0.3,0.7]],figsize=(10,4))
+
+        # streaming fit of the sin/cos(n theta) components of both legs; with
+        # stop_tolerance (relative to the largest amplitude, e.g. 0.01) the scan
+        # ends once the coefficients have settled
+        self.fitter = harmonic_fit.RLSFitter(orders) if fit or stop_tolerance else None
+        self.stop_tolerance = stop_tolerance
+        self.fit_pending = 0
+        self.stopped = False
 
         self.k6221.write("SOUR:WAVE:ARM")
         self.k6221.write("SOUR:WAVE:INIT")
-        time.sleep(1)
-        self.scan_position(pos1,pos2,scan_rate,self.field0)
-        time.sleep(1)
-        self.scan_position(pos2,pos1,scan_rate,self.field0)
-        time.sleep(1)
+        self.profiler.sleep(1)
+        self.error = None # instrument error that ended the scan early
+        with self.profiler.phase('acquire'),self.telemetry or contextlib.nullcontext():
+            if zigzag:
+                self.scan_position_pipelined(legs,first,scan_rate,self.field0,buffered,sample_rate)
+            else:
+                for self.leg in range(first,len(legs)):
+                    ini_pos,end_pos = legs[self.leg]
+                    if buffered or threaded or digitizer is not None:
+                        # one leg at a time, settling at its start
+                        self.scan_position_pipelined(legs[:self.leg+1],self.leg,scan_rate,self.field0,buffered,sample_rate)
+                    else:
+                        self.scan_position(ini_pos,end_pos,scan_rate,self.field0,sample_rate)
+                    if self.stopped or self.error is not None:
+                        break
+                    if self.leg == 0:
+                        self.profiler.sleep(1)
+        if self.fitter is not None:
+            print(self.fitter.text())
+        self.profiler.sleep(1)
         self.k6221.write(":OUTP OFF")  # Turn on the output
         #self.k2901.write(":OUTP OFF")  # Turn on the output
 
-        print('measurement compeleted')
-        self.animating = False  # Stop the animation after data collection is complete
-        plt.ioff()
-        plt.close()
-        plt.clf()
+        if self.error is not None:
+            # the data taken so far is saved, not catalogued; a scheduler retries or
+            # resumes the run and the completed attempt registers it once
+            print('measurement incomplete: {}'.format(self.error))
+            self.finish()
+        else:
+            print('measurement compeleted')
+            if defer is not None:
+                defer(self.finish)
+            else:
+                self.finish()
 
-        # Close the connections
-        self.sr830.close()
+        # Close the connections (a session keeps them open for the next run)
+        if session is None:
+            self.sr830.close()
 
-    def set_config(self):
+    @staticmethod
+    def output_name(file_name,temperature0,field0,harm,**params):
+        # data file name without extension; the scheduler checks that runs differ in it
+        return file_name+'temperature_{}K_field_{}Oe_{}harm.csv'.format(temperature0,field0,harm)
+
+    def finish(self):
+        # Saving and closing the plot. A pipelined scheduler runs this in the
+        # background while the next run already ramps temperature/field.
+        with self.profiler.phase('save'):
+            self.writer.close()
+            if self.fitter is not None:
+                self.fitter.save(self.path_name + self.file_name)
+            if self.catalog is not None and self.error is None:
+                run_catalog.register(self.catalog,'rotator',self,self.config_commands(),
+                                     self.fitter.results() if self.fitter is not None else None)
+        with self.profiler.phase('plot'):
+            self.plotter.close()
+        self.profiler.save(self.path_name + self.file_name)
+
+    def config_commands(self):
+        sr830 = []
+        k6221 = []
         # Configure Keysight B2901A for pulsed current output
         # Configure Keithley 2182A to measure voltage
-        self.sr830.write("FREQ 1713")
-        self.sr830.write("SLVL 0.01")
-        if self.harm == 2:
-            self.sr830.write("PHAS 90")
-        elif self.harm ==1:
-            self.sr830.write("PHAS 0")
-        self.sr830.write("HARM {}".format(self.harm))
-        self.sr830.write("ISRC 1")
+        sr830.append("FREQ 1713")
+        sr830.append("SLVL 0.01")
+        if self.harm in PHASES:
+            sr830.append("PHAS {}".format(PHASES[self.harm]))
+        sr830.append("HARM {}".format(self.harm))
+        sr830.append("ISRC 1")
         if self.harm == 2:
-            # self.sr830.write("SENS 10")
-            self.sr830.write("SENS 13")
-            # self.sr830.write("SENS 15")
+            # sr830.append("SENS 10")
+            sr830.append("SENS 13")
+            # sr830.append("SENS 15")
         elif self.harm == 1:
-            self.sr830.write("SENS 26") #1mV
-        self.sr830.write("OFIT 8")
-        self.sr830.write("OFSL 8")
-        self.sr830.write("RSLP 1")
-        self.sr830.write("FMOD 0")
+            sr830.append("SENS 26") #1mV
+        sr830.append("OFIT 8")
+        sr830.append("OFSL 8")
+        sr830.append("RSLP 1")
+        sr830.append("FMOD 0")
         #self.k2901.write(":SOUR:FUNC:MODE VOLT")
         #self.k2901.write(f":SOUR:VOLT {self.volt* 1e-3}")
         #self.k2901.write(":SENS:CURR:PROT 0.002")
 
-        self.k6221.write('*RST')
-        self.k6221.write('SOUR:WAVE:AMPL 5e-3')
-        self.k6221.write('SOUR:WAVE:FREQ 1713')
-        self.k6221.write('SOUR:WAVE:PMAR:STAT 1')
-        self.k6221.write('SOUR:WAVE:PMAR:LEV 0')
-        self.k6221.write('SOUR:WAVE:PMAR:OLINE 3')
-
-    def set_temp(self,temperature0,t_rate=10):
-        print('start to set temperature to {}'.format(temperature0))
-        self.ppms.setTemperature(temperature0,t_rate)
-        time.sleep(0.5)
-        _, temperature, status = self.ppms.getTemperature()
-        while status != 1: #1 stable 6 Tracking
-            _, temperature, status = self.ppms.getTemperature()
-            print(temperature,status)
-            time.sleep(1)
-            pass
-        print('temperature set successfully')
+        k6221.append('*RST')
+        k6221.append('SOUR:WAVE:AMPL 5e-3')
+        k6221.append('SOUR:WAVE:FREQ 1713')
+        k6221.append('SOUR:WAVE:PMAR:STAT 1')
+        k6221.append('SOUR:WAVE:PMAR:LEV 0')
+        k6221.append('SOUR:WAVE:PMAR:OLINE 3')
+
+        return [(self.sr830,sr830),(self.k6221,k6221)]
+
+    def set_config(self):
+        # the instruments sit on different GPIB boards and are configured concurrently
+        async_instruments.run(async_instruments.configure(self.config_commands()))
+
+    def set_temp(self,temperature0,t_rate=10,hold=0):
+        # hold: seconds the temperature must stay stable before returning
+        with self.profiler.phase('settle'):
+            settle.set_temperature(self.ppms,temperature0,t_rate,hold=hold,report=self.reporter('temperature'))
+
+    def reporter(self,quantity):
+        # settle progress for the live stream
+        return self.publisher.settle_reporter(quantity) if self.publisher is not None else None
 
     def set_field(self,field0,h_rate=200):
-        print('start to set field to {}'.format(field0))
-        self.ppms.setField(field0,h_rate)
-        time.sleep(0.5)
-        _,field, status = self.ppms.getField()
-        while status != 4 or np.abs(field-field0)>1: 
-            _,field, status = self.ppms.getField()
-            print(field,status)
-            time.sleep(1)
-            pass
-        print('field set successfully')
-    
+        with self.profiler.phase('settle'):
+            settle.set_field(self.ppms,field0,h_rate,report=self.reporter('field'))
+
     def set_position(self,pos0,p_rate=5):
-        print('start to set position to {}'.format(pos0))
-        self.ppms.setPosition(pos0,p_rate)
-        time.sleep(0.5)
-        _,pos, status = self.ppms.getPosition()
-        while status != 1 or np.abs(pos-pos0)>0.1: 
-            _,pos, status = self.ppms.getPosition()
-            print(pos,status)
-            time.sleep(1)
-            pass
-        print('position set successfully')
-
-
-    def scan_position(self,ini_pos, end_pos, scan_rate,field):
+        with self.profiler.phase('settle'):
+            settle.set_position(self.ppms,pos0,p_rate,report=self.reporter('position'))
+
+
+    def scan_position(self,ini_pos, end_pos, scan_rate,field,sample_rate=None):
         print('Start to scan position')
-        time.sleep(0.1)
-        def animate(i):
-            if not self.animating:
-                ani.event_source.stop()  # Stop the animation
-                return
-            self.ax1.clear()
-            self.ax1.plot(self.positions, self.voltages, '-o', color='#1f77b4')
-            self.ax2.clear()
-            self.ax2.plot(self.positions, self.voltages_y, '-o', color='#1f77b4')
-        # Start the animation
-        ani = FuncAnimation(self.fig, animate, interval=2000, cache_frame_data=False)  # Update every 2000 ms
-        
+        self.profiler.sleep(0.1)
         self.set_position(ini_pos)
-        time.sleep(1)
+        self.profiler.sleep(1)
         self.set_field(field)
-        time.sleep(1)
+        self.profiler.sleep(1)
+        self.target = (end_pos,scan_rate,0)
         self.ppms.setPosition(end_pos, scan_rate)
-        time.sleep(0.1)
+        self.profiler.sleep(0.1)
         _,pos,status = self.ppms.getPosition()
         while np.abs(pos - end_pos) > 0.1 or status != 1:
             try:
@@ -168,28 +259,115 @@ class AHE():
                 # The response will typically be a comma-separated string, e.g., "X,Y"
                 real_part, imaginary_part = response.split(',')
                 voltage,voltage_y =map(float,[real_part,imaginary_part])
+                t = time.monotonic()
                 _,pos,status = self.ppms.getPosition()
-                self.positions.append(pos)
-                self.voltages.append(voltage)
-                self.voltages_y.append(voltage_y)
-                time.sleep(0.001)
-                plt.pause(0.001)
+                self.record(t=t,position=pos,x=voltage,y=voltage_y)
+                if self.stop_early(pos,scan_rate):
+                    break
+                if self.autorange is not None:
+                    self.autorange.check(t,voltage,voltage_y)
+                    self.profiler.sleep(1/sample_rate)
+                else:
+                    self.profiler.sleep(0.001)
             except Exception as e:
+                self.error = e
                 print(f"Error during data collection: {e}")
                 break
 
 
-        df = pd.DataFrame({'position (degree)': self.positions, 'voltage_x (V)': self.voltages, 'voltage_y (V)': self.voltages_y})
-        df.to_csv(self.path_name + self.file_name + '.csv')
-        plt.savefig(self.path_name + self.file_name + '.png', dpi=300)
+        self.writer.flush()
+        self.plotter.save(self.path_name + self.file_name + '.png', dpi=300)
+
+    def scan_position_pipelined(self,legs,first,scan_rate,field,buffered,sample_rate):
+        # all legs from `first` on in one acquisition: PPMS polling and lock-in reads
+        # run in their own threads, every lock-in sample is placed on the angle axis
+        # from its timestamp, and the rotator turns around as soon as it reaches an
+        # end, without settling in between
+        print('Start to scan position (pipelined, {} legs)'.format(len(legs)-first))
+        self.profiler.sleep(0.1)
+        self.set_position(legs[first][0])
+        self.profiler.sleep(1)
+        self.set_field(field)
+        self.profiler.sleep(1)
+        read,drain = acquisition.sweep_reader(self.sr830,buffered,sample_rate,
+                                              zigzag_sweep.duration(legs[first:],scan_rate)+30,self.autorange,
+                                              self.digitizer,self.demodulator() if self.digitizer is not None else None)
+        pipeline = acquisition.Pipeline(self.ppms.getPosition,read)
+        pipeline.start()
+        for self.leg in range(first,len(legs)):
+            ini_pos,end_pos = legs[self.leg]
+            self.target = (end_pos,scan_rate,zigzag_sweep.duration(legs[self.leg+1:],scan_rate))
+            if self.sweep is not None:
+                self.sweep.start(time.monotonic(),ini_pos,end_pos)
+            self.ppms.setPosition(end_pos, scan_rate)
+            self.profiler.sleep(0.1)
+            while np.abs(pipeline.value - end_pos) > 0.1 or pipeline.status != 1:
+                if pipeline.error is not None:
+                    break
+                t,positions,x,y = pipeline.collect()
+                self.record(t=t,position=positions,x=x,y=y)
+                if self.stop_early(pipeline.value,scan_rate):
+                    break
+                self.profiler.sleep(0.2)
+            if pipeline.error is not None:
+                self.error = pipeline.error
+                print(f"Error during data collection: {pipeline.error}")
+                break
+            if self.stopped:
+                break
+        pipeline.stop()
+        if drain is not None:
+            pipeline.add(*drain())
+        t,positions,x,y = pipeline.collect(final=True)
+        self.record(t=t,position=positions,x=x,y=y)
+        self.writer.flush()
+        print('{} points collected'.format(self.writer.n_written))
+
+        self.plotter.save(self.path_name + self.file_name + '.png', dpi=300)
+
+    def demodulator(self):
+        return demod.Demodulator(FREQUENCY,self.harmonics,self.bandwidth,phases=[PHASES.get(n,0) for n in self.harmonics])
+
+    def record(self,**columns):
+        # keep the new samples and hand them on to the writer, the plotter and the fit
+        harmonics = ()
+        if self.digitizer is not None:
+            # all demodulated harmonics go to the file, harm to the plot and the fit
+            X = np.reshape(columns['x'],(-1,len(self.harmonics)))
+            Y = np.reshape(columns['y'],(-1,len(self.harmonics)))
+            i = self.harmonics.index(self.harm) if self.harm in self.harmonics else 0
+            columns['x'],columns['y'] = X[:,i],Y[:,i]
+            harmonics = [v[:,j] for j in range(len(self.harmonics)) for v in (X,Y)]
+        block = acquisition.record(self,'position',columns,harmonics)
+        if self.fitter is not None:
+            with self.profiler.phase('fit'):
+                self.fitter.add(block['position'],block['x'],block['y'])
+                self.fit_pending += len(block)
+                if self.fit_pending >= 100:
+                    self.fit_pending = 0
+                    self.fitter.check()
+                    self.plotter.fit(0,[self.fitter.curve(0)])
+                    self.plotter.fit(1,[self.fitter.curve(1)])
+                    self.plotter.title(self.fitter.text())
+
+    def stop_early(self,pos,scan_rate):
+        # coefficients of X settled to stop_tolerance: hold the position here
+        if self.stop_tolerance is None or not self.fitter.converged(self.stop_tolerance):
+            return False
+        print('harmonics converged at {:.1f} degree, stopping the scan'.format(pos))
+        self.ppms.setPosition(pos,scan_rate)
+        self.stopped = True
+        return True
 
 def end_mearsument():
+    from labdrivers.quantumdesign import qdinstrument
     ppms=qdinstrument.QdInstrument('DynaCool','192.168.0.4')
     ppms.setTemperature(300)
     ppms.setField(0)
     ppms.setPosition(0,1)
 
 if __name__ == "__main__":
+    os.chdir(sys.path[0])
     for i in [550,-550]:
         AHE(path_name='./Feb19_15-3-4_LSAT/device12_angle/',
                 file_name ='Jul13_rotate',
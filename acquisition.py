@@ -0,0 +1,214 @@
+import threading
+import queue
+import time
+import numpy as np
+from sr830_buffer import AxisLog,SR830Buffer
+import demod
+
+# Producer/consumer acquisition: one thread polls the PPMS (field or position),
+# another streams lock-in samples, and the consumer places every lock-in sample
+# on the PPMS axis by interpolating between the two nearest readings.
+
+def snap_reader(sr830,interval=0):
+    # interval: minimum time between two reads (s)
+    def read():
+        t_a = time.monotonic()
+        response = sr830.query('SNAP?1,2')
+        t = (t_a+time.monotonic())/2
+        x,y = map(float,response.split(','))
+        if interval:
+            time.sleep(max(t_a+interval-time.monotonic(),0))
+        return np.array([t]),np.array([x]),np.array([y])
+    return read
+
+def buffer_reader(buffer,interval=0.05):
+    def read():
+        t,x,y = buffer.fetch()
+        if len(t) == 0:
+            time.sleep(interval)
+        return t,x,y
+    return read
+
+def sweep_reader(sr830,buffered,sample_rate,duration,autorange=None,digitizer=None,demodulator=None):
+    # (read, drain) of a pipelined sweep of duration s: the digitizer through the
+    # software lock-in, the armed and started SR830 buffer, or SNAP? polls, each
+    # through the autorange if there is one; drain() returns what is left after
+    # the sweep (None for SNAP?)
+    if digitizer is not None:
+        digitizer.start()
+        read = drain = demod.reader(digitizer,demodulator)
+    elif buffered:
+        buffer = SR830Buffer.for_duration(sr830,duration,sample_rate)
+        print('SR830 buffer sample rate {} Hz'.format(buffer.rate))
+        buffer.arm()
+        buffer.start()
+        read = buffer_reader(buffer)
+        def drain():
+            buffer.pause()
+            return buffer.fetch_all()
+    else:
+        read = snap_reader(sr830,1/sample_rate if autorange is not None else 0)
+        drain = None
+    if autorange is not None:
+        read = autorange.reader(read)
+    return read,drain
+
+def record(measurement,axis,columns,extra=()):
+    # what the record() of the measurements share: drop the samples taken while
+    # the lock-in range settles, tag the rest (sensitivity, direction and cycle,
+    # telemetry), store and write them, checkpoint, plot and publish; extra: more
+    # values per sample written before the telemetry (not with autorange).
+    # Returns the stored block.
+    m = measurement
+    if m.autorange is not None:
+        keep = m.autorange.settled(columns['t'])
+        columns = {k:np.broadcast_to(v,keep.shape)[keep] for k,v in columns.items()}
+        columns['sensitivity'] = m.autorange.tag(columns['t'])
+    if m.sweep is not None:
+        columns['direction'],columns['cycle'] = m.sweep.tag(columns['t'])
+    if m.telemetry is not None:
+        columns.update(m.telemetry.place(columns['t']))
+    block = m.store.append(**columns)
+    m.profiler.count(len(block))
+    with m.profiler.phase('save'):
+        values = [block[axis],block['x'],block['y']]
+        if m.autorange is not None:
+            values.append(block['sensitivity'])
+        if m.sweep is not None:
+            values.extend([block['direction'],block['cycle']])
+        values.extend(extra)
+        if m.telemetry is not None:
+            values.extend(block[c] for c in m.telemetry.channels)
+        m.writer.append(*values)
+    if m.checkpoint is not None and len(block) and m.writer.n_written != m.resume.get('rows',0):
+        # a chunk went to disk: the sweep can resume after its last point
+        m.resume = {'rows':m.writer.n_written,'leg':m.leg,axis:float(block[axis][-1])}
+        m.checkpoint.progress(**m.resume)
+    with m.profiler.phase('plot'):
+        m.plotter.add(block[axis],block['x'],block['y'])
+    if m.publisher is not None and len(block):
+        value = float(block[axis][-1])
+        end,scan_rate,rest = m.target
+        m.publisher.data(block)
+        m.publisher.status('acquiring',axis,target=end,value=value,eta=np.abs(end-value)/scan_rate+rest)
+    return block
+
+class Poller(threading.Thread):
+    def __init__(self,getter,interval=0.05):
+        super().__init__(daemon=True)
+        self.getter = getter
+        self.interval = interval
+        self.log = AxisLog()
+        self.lock = threading.Lock()
+        self.value = None
+        self.status = None
+        self.error = None
+        self.stopped = threading.Event()
+
+    def poll(self):
+        with self.lock:
+            self.value,self.status = self.log.poll(self.getter)
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                self.poll()
+                self.stopped.wait(self.interval)
+        except Exception as e:
+            self.error = e
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def last_time(self):
+        with self.lock:
+            return self.log.last_time()
+
+    def place(self,t):
+        with self.lock:
+            return self.log.place(t)
+
+class Reader(threading.Thread):
+    def __init__(self,read):
+        super().__init__(daemon=True)
+        self.read = read
+        self.samples = queue.Queue()
+        self.error = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                t,x,y = self.read()
+                if len(t):
+                    self.samples.put((t,x,y))
+        except Exception as e:
+            self.error = e
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class Pipeline():
+    def __init__(self,getter,read,poll_interval=0.05):
+        self.poller = Poller(getter,poll_interval)
+        self.reader = Reader(read)
+        self.pending_t = np.empty(0)
+        self.pending_x = np.empty(0)
+        self.pending_y = np.empty(0)
+
+    def start(self):
+        # first reading before any sample so that the merge has an anchor
+        self.poller.poll()
+        self.poller.start()
+        self.reader.start()
+
+    def stop(self):
+        self.reader.stop()
+        self.poller.stop()
+
+    @property
+    def value(self):
+        return self.poller.value
+
+    @property
+    def status(self):
+        return self.poller.status
+
+    @property
+    def error(self):
+        return self.poller.error or self.reader.error
+
+    def add(self,t,x,y):
+        # x and y may also be (samples, harmonics), see demod.reader
+        if len(self.pending_t) == 0:
+            self.pending_t,self.pending_x,self.pending_y = np.asarray(t),np.asarray(x),np.asarray(y)
+            return
+        self.pending_t = np.concatenate([self.pending_t,t])
+        self.pending_x = np.concatenate([self.pending_x,x])
+        self.pending_y = np.concatenate([self.pending_y,y])
+
+    def drain(self):
+        # everything queued since the last call, concatenated once
+        items = []
+        while True:
+            try:
+                items.append(self.reader.samples.get_nowait())
+            except queue.Empty:
+                break
+        if items:
+            t,x,y = zip(*items)
+            self.add(np.concatenate(t),np.concatenate(x),np.concatenate(y))
+
+    def collect(self,final=False):
+        # samples placed on the axis so far: (t, axis, x, y)
+        self.drain()
+        if final:
+            n = len(self.pending_t)
+        else:
+            # only samples bracketed by PPMS readings can be placed yet
+            n = np.searchsorted(self.pending_t,self.poller.last_time(),side='right')
+        t,x,y = self.pending_t[:n],self.pending_x[:n],self.pending_y[:n]
+        self.pending_t,self.pending_x,self.pending_y = self.pending_t[n:],self.pending_x[n:],self.pending_y[n:]
+        return t,self.poller.place(t),x,y
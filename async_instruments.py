@@ -0,0 +1,78 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import settle
+
+# asyncio layer over the blocking pyvisa / QdInstrument calls. Every bus (GPIB
+# board, PPMS socket) gets one worker thread, so commands on the same bus stay
+# in order while independent buses run at the same time.
+# Only what is run through here is serialised: the instrument configuration
+# (configure) and the temperature settle (on_ppms). During a sweep the PPMS is
+# called directly from the main thread, the acquisition poller and the
+# telemetry thread.
+
+class Bus():
+    def __init__(self,name):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix=name)
+
+    async def call(self,func,*args,**kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,functools.partial(func,*args,**kwargs))
+
+BUSES = {}
+
+def bus(name):
+    if name not in BUSES:
+        BUSES[name] = Bus(name)
+    return BUSES[name]
+
+def bus_for(resource):
+    # 'GPIB1::8::INSTR' -> bus 'GPIB1'
+    return bus(getattr(resource,'resource_name','').split('::')[0] or repr(resource))
+
+class AsyncResource():
+    def __init__(self,resource):
+        self.resource = resource
+        self.bus = bus_for(resource)
+
+    async def write(self,command):
+        return await self.bus.call(self.resource.write,command)
+
+    async def query(self,command):
+        return await self.bus.call(self.resource.query,command)
+
+    async def query_binary_values(self,command,**kwargs):
+        return await self.bus.call(self.resource.query_binary_values,command,**kwargs)
+
+    async def write_all(self,commands):
+        for command in commands:
+            await self.write(command)
+
+async def on_ppms(func,*args,**kwargs):
+    # run a blocking function (e.g. a settle loop) on the PPMS bus
+    return await bus('PPMS').call(func,*args,**kwargs)
+
+async def configure(commands):
+    # commands: [(resource, [command, ...]), ...]
+    await asyncio.gather(*[AsyncResource(resource).write_all(c) for resource,c in commands])
+
+def cancel():
+    # stop the work left on the bus threads, e.g. a settle loop after Ctrl-C in
+    # the main thread; the buses start fresh on the next call
+    settle.CANCEL.set()
+    try:
+        for name in list(BUSES):
+            BUSES.pop(name).executor.shutdown(wait=True,cancel_futures=True)
+    finally:
+        settle.CANCEL.clear()
+
+def run(*coroutines):
+    # run coroutines concurrently from synchronous code, return their results
+    async def main():
+        return await asyncio.gather(*coroutines)
+    try:
+        return asyncio.run(main())
+    except BaseException:
+        cancel()
+        raise
@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import scheduler
+import simulated
+
+# Throughput benchmark: runs the measurement classes end to end against the
+# simulated instruments (no hardware, no plot window) and reports points/s,
+# wall time and peak Python memory per scenario.
+#
+#   python benchmark.py --speedup 50 --latency 0.002 --json results.json
+
+def spin_pumping(path,**options):
+    import spin_pumping
+    return spin_pumping.AHE(path_name=path,file_name='bench_',frequency=4,temperature0=300,field0=800,
+                            scan_rate=20,harm=1,set_temp=False,waiting_time=0,headless=True,**options)
+
+def rotator(path,**options):
+    import Rotator_PPMS_module_6221
+    return Rotator_PPMS_module_6221.AHE(path_name=path,file_name='bench_',temperature0=300,field0=550,
+                                        scan_rate=2,harm=2,set_temp=False,waiting_time=0,pos1=0,pos2=360,
+                                        headless=True,**options)
+
+def pulse_current(path,points=15,**options):
+    import pulse_current_PPMS_module
+    c_max = 9
+    current_list = list(np.linspace(0,c_max,points)) + list(np.linspace(c_max,-c_max,points))
+    return pulse_current_PPMS_module.Current_swtiching(path_name=path,temperature0=300,sat_field=-500,field0=0,
+                                                       current_list=np.array(current_list),width=1,mear_curr=0.1,
+                                                       set_temp=False,wating_time=0,headless=True,**options)
+
+# name -> (measurement, options)
+SCENARIOS = {
+    'spin_pumping': (spin_pumping,{}),
+    'spin_pumping_buffered': (spin_pumping,{'buffered':True}),
+    'spin_pumping_threaded': (spin_pumping,{'threaded':True}),
+    'spin_pumping_adaptive': (spin_pumping,{'buffered':True,'adaptive':True}),
+    'spin_pumping_autorange': (spin_pumping,{'buffered':True,'autorange':True}),
+    'spin_pumping_zigzag': (spin_pumping,{'buffered':True,'zigzag':True}),
+    'rotator': (rotator,{}),
+    'rotator_buffered': (rotator,{'buffered':True}),
+    'rotator_threaded': (rotator,{'threaded':True}),
+    'rotator_autorange': (rotator,{'buffered':True,'autorange':True}),
+    'rotator_zigzag': (rotator,{'buffered':True,'zigzag':True}),
+    'rotator_digitizer': (rotator,{'buffered':True,'digitizer':True}), # software lock-in on the simulated digitizer
+    'pulse_current': (pulse_current,{}),
+    'pulse_current_sequenced': (pulse_current,{'sequenced':True}),
+}
+
+def run_scenario(name,speedup=50,latency=0.002,ppms_latency=0.02,points=15):
+    measurement,options = SCENARIOS[name]
+    if measurement is pulse_current:
+        options = dict(options,points=points)
+    ppms = simulated.SimPPMS(speedup=speedup,latency=ppms_latency,settle_time=0)
+    if options.get('digitizer'):
+        options = dict(options,digitizer=simulated.SimDigitizer(ppms))
+    session = scheduler.Session(ppms=ppms,rm=simulated.SimResourceManager(ppms,latency=latency))
+    with tempfile.TemporaryDirectory() as path:
+        tracemalloc.start()
+        t = time.perf_counter()
+        result = measurement(path+os.sep,session=session,**options)
+        wall = time.perf_counter()-t
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    session.close()
+    summary = result.profiler.summary()
+    return {'scenario':name,'points':summary['points'],'wall':wall,
+            'points_per_s':summary['points']/wall if wall > 0 else 0,
+            'peak_memory_mb':peak/2**20,'phases':summary['phases']}
+
+def report(results):
+    lines = ['{:<26s} {:>8s} {:>9s} {:>10s} {:>9s}'.format('scenario','points','wall s','points/s','peak MB')]
+    for r in results:
+        lines.append('{:<26s} {:>8d} {:>9.2f} {:>10.1f} {:>9.1f}'.format(
+            r['scenario'],r['points'],r['wall'],r['points_per_s'],r['peak_memory_mb']))
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='throughput benchmark on simulated instruments')
+    parser.add_argument('scenarios',nargs='*',default=list(SCENARIOS),help='any of: '+', '.join(SCENARIOS))
+    parser.add_argument('--speedup',type=float,default=50,help='PPMS ramps run this much faster than set')
+    parser.add_argument('--latency',type=float,default=0.002,help='s per GPIB call')
+    parser.add_argument('--ppms-latency',type=float,default=0.02,help='s per PPMS call')
+    parser.add_argument('--points',type=int,default=15,help='set points per branch of the pulse scan')
+    parser.add_argument('--json',help='save the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for name in args.scenarios:
+        print('--- {}'.format(name))
+        results.append(run_scenario(name,args.speedup,args.latency,args.ppms_latency,args.points))
+    print(report(results))
+    if args.json:
+        with open(args.json,'w') as f:
+            json.dump(results,f,indent=1)
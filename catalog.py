@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import sqlite3
+import numpy as np
+
+# Run catalog: every run registers its parameters, instrument configuration,
+# timing and fit results in a SQLite file, with the main parameters as columns
+# so that series can be selected without parsing file names. load() pulls the
+# .npy data of selected runs into one columnar dataset, optionally cached as
+# one memory-mapped .npy per column.
+#
+#   runs = catalog.Catalog('./SP/catalog.sqlite').runs('spin_pumping',temperature=(50,300),harm=1)
+#   data = catalog.load(runs,cache='./SP/cache_T_series')
+#   data['run'], data['field (Oe)'], data['voltage_x (V)']
+
+# indexed columns and the measurement parameter each one comes from
+INDEXED = {'temperature':'temperature0','field':'field0','frequency':'frequency','harm':'harm',
+           'scan_rate':'scan_rate'}
+
+SCHEMA = '''create table if not exists runs (
+    id integer primary key, kind text, data text, registered real, n_points integer,
+    temperature real, field real, frequency real, harm integer, scan_rate real,
+    columns text, params text, config text, timing text, fit text)'''
+
+def to_json(value):
+    return json.dumps(value,default=lambda v: v.tolist() if isinstance(v,np.ndarray) else float(v))
+
+class Catalog():
+    def __init__(self,path):
+        self.path = path
+        with self.connect() as db:
+            db.execute(SCHEMA)
+            db.execute('create index if not exists runs_kind_temperature on runs (kind, temperature)')
+
+    def connect(self):
+        # one connection per call, so runs finishing in a background thread can register too
+        return sqlite3.connect(self.path,timeout=30)
+
+    def register(self,kind,data,params,columns,n_points,config=None,timing=None,fit=None):
+        # data: path of the run's .npy file; returns the run id
+        row = {'kind':kind,'data':os.path.abspath(data),'registered':time.time(),'n_points':n_points,
+               'columns':to_json(list(columns)),'params':to_json(params),'config':to_json(config),
+               'timing':to_json(timing),'fit':to_json(fit)}
+        row.update({column:params.get(name) for column,name in INDEXED.items()})
+        with self.connect() as db:
+            cursor = db.execute('insert into runs ({}) values ({})'.format(','.join(row),','.join('?'*len(row))),
+                                [v if not isinstance(v,np.generic) else v.item() for v in row.values()])
+            return cursor.lastrowid
+
+    def runs(self,kind=None,order='id',**criteria):
+        # criteria on the indexed columns: a value, or a (low, high) range
+        where,args = [],[]
+        if kind is not None:
+            where.append('kind = ?')
+            args.append(kind)
+        for column,value in criteria.items():
+            if column not in INDEXED:
+                raise ValueError('{} is not an indexed column ({})'.format(column,', '.join(INDEXED)))
+            if isinstance(value,(tuple,list)):
+                where.append('{} between ? and ?'.format(column))
+                args.extend(value)
+            else:
+                where.append('{} = ?'.format(column))
+                args.append(value)
+        sql = 'select * from runs' + (' where '+' and '.join(where) if where else '') + ' order by '+order
+        with self.connect() as db:
+            db.row_factory = sqlite3.Row
+            rows = [dict(row) for row in db.execute(sql,args)]
+        for row in rows:
+            for key in ('columns','params','config','timing','fit'):
+                row[key] = json.loads(row[key])
+        return rows
+
+def register(catalog,kind,measurement,config_commands,fit=None):
+    # register a finished measurement (its writer, parameters, profiler)
+    writer = measurement.writer
+    config = {resource.resource_name:commands for resource,commands in config_commands}
+    timing = measurement.profiler.summary()
+    timing = {'wall':timing['wall'],'points':timing['points'],'phases':timing['phases']}
+    return catalog.register(kind,writer.path+'.npy',measurement.params,writer.columns,writer.n_written,
+                            config,timing,fit)
+
+def open_catalog(catalog,path_name):
+    # catalog argument of the measurement classes: True for <path_name>/catalog.sqlite,
+    # a file name, a Catalog, or False/None for none
+    if catalog is True:
+        return Catalog(os.path.join(path_name,'catalog.sqlite'))
+    if isinstance(catalog,str):
+        return Catalog(catalog)
+    return catalog or None
+
+def load(runs,columns=None,cache=None):
+    # one dataset of the selected runs: {'run': run id per row, column: values};
+    # with cache (a directory) the columns are written there once and returned
+    # memory mapped
+    shared = {path for path in (run['data'] for run in runs) if sum(r['data'] == path for r in runs) > 1}
+    if shared:
+        raise ValueError('runs {} share the data file {}'.format(
+            [run['id'] for run in runs if run['data'] in shared],', '.join(sorted(shared))))
+    data = [np.load(run['data'],mmap_mode='r') for run in runs]
+    for run,d in zip(runs,data):
+        # a data file rewritten by a later run no longer holds the run registered here
+        if len(d) != run['n_points']:
+            raise ValueError('run {}: {} has {} points, {} registered'.format(run['id'],run['data'],len(d),run['n_points']))
+    if columns is None:
+        columns = [c for c in runs[0]['columns'] if all(c in run['columns'] for run in runs)]
+    manifest = {'runs':[run['id'] for run in runs],'columns':list(columns),
+                'mtimes':[os.path.getmtime(run['data']) for run in runs]}
+    if cache is not None and os.path.exists(os.path.join(cache,'manifest.json')):
+        with open(os.path.join(cache,'manifest.json')) as f:
+            if json.load(f) == manifest:
+                return {c:np.load(os.path.join(cache,c+'.npy'),mmap_mode='r') for c in ['run']+list(columns)}
+    n = sum(len(d) for d in data)
+    if cache is not None:
+        os.makedirs(cache,exist_ok=True)
+        out = {c:np.lib.format.open_memmap(os.path.join(cache,c+'.npy'),'w+','f8',(n,)) for c in columns}
+        out['run'] = np.lib.format.open_memmap(os.path.join(cache,'run.npy'),'w+','i8',(n,))
+    else:
+        out = {c:np.empty(n) for c in columns}
+        out['run'] = np.empty(n,dtype='i8')
+    start = 0
+    for run,d in zip(runs,data):
+        for c in columns:
+            out[c][start:start+len(d)] = d[c]
+        out['run'][start:start+len(d)] = run['id']
+        start += len(d)
+    if cache is not None:
+        for array in out.values():
+            array.flush()
+        with open(os.path.join(cache,'manifest.json'),'w') as f:
+            json.dump(manifest,f)
+    return out
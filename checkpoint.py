@@ -0,0 +1,64 @@
+import os
+import json
+import numpy as np
+
+# Progress of a series of runs, saved to a JSON file after every completed run
+# and every flushed chunk of a sweep, so that a restarted series skips finished
+# runs and continues the interrupted one from its last saved set point.
+#
+#   scheduler.Scheduler(Current_swtiching,runs,common,checkpoint='series.json').run()
+#
+# The measurement classes take checkpoint=... and store their own progress
+# (rows written and the set point / field / angle reached) with progress();
+# resume() gives it back when the same run is started again.
+
+class Checkpoint():
+    def __init__(self,path):
+        self.path = path
+        self.state = {'done':[],'current':None,'progress':{},'temperature':None}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state.update(json.load(f))
+
+    def save(self):
+        # write to a temporary file and rename, so a crash never leaves half a file
+        with open(self.path+'.tmp','w') as f:
+            json.dump(self.state,f,indent=1,default=float)
+        os.replace(self.path+'.tmp',self.path)
+
+    def key(self,params):
+        return json.dumps(params,sort_keys=True,default=lambda v: v.tolist() if isinstance(v,np.ndarray) else str(v))
+
+    def done(self,params):
+        return self.key(params) in self.state['done']
+
+    def start(self,params):
+        # progress is kept only if this is the run that was interrupted
+        key = self.key(params)
+        if self.state['current'] != key:
+            self.state['current'] = key
+            self.state['progress'] = {}
+            self.save()
+
+    def resume(self):
+        return dict(self.state['progress'])
+
+    def progress(self,**state):
+        self.state['progress'].update(state)
+        self.save()
+
+    def settled(self,temperature):
+        self.state['temperature'] = temperature
+        self.save()
+
+    def at_temperature(self,temperature,ppms,tolerance=0.5):
+        # the last settled temperature is this one and the PPMS is still there
+        if self.state['temperature'] is None or self.state['temperature'] != temperature:
+            return False
+        return np.abs(ppms.getTemperature()[1]-temperature) <= tolerance
+
+    def finish(self,params):
+        self.state['done'].append(self.key(params))
+        self.state['current'] = None
+        self.state['progress'] = {}
+        self.save()
@@ -0,0 +1,107 @@
+import os
+import time
+import numpy as np
+
+# Append-only writer fed by the acquisition loop. Rows are buffered and flushed
+# to disk when flush_rows are pending or flush_interval seconds have passed, so a
+# crash loses at most one chunk and both files can be read while the scan runs.
+#   csv: same layout as DataFrame.to_csv (leading index column)
+#   npy: structured array, header rewritten after every flush so that
+#        np.load(path, mmap_mode='r') always sees the rows written so far
+# With resume_rows the files of an interrupted run are cut back to that many
+# rows and appended to.
+
+class StreamWriter():
+    def __init__(self,path,columns,formats=('csv','npy'),flush_rows=1000,flush_interval=5.0,resume_rows=None):
+        self.path = path
+        self.columns = list(columns)
+        self.dtype = np.dtype([(c,'f8') for c in self.columns])
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.n_pending = 0
+        self.n_written = 0
+        self.last_flush = time.monotonic()
+        self.csv = None
+        self.npy = None
+        # fixed npy header size (magic + version + length + dict, 64-byte aligned)
+        # large enough for any row count, so it can be rewritten in place
+        self.header_size = -(-(12+len(self.header_dict(10**15)))//64)*64
+        if resume_rows is not None:
+            self.resume(formats,resume_rows)
+            return
+        if 'csv' in formats:
+            self.csv = open(path+'.csv','w',newline='')
+            self.csv.write(','.join(['']+self.columns)+'\n')
+        if 'npy' in formats:
+            self.npy = open(path+'.npy','wb')
+            self.npy.write(self.npy_header(0))
+
+    def resume(self,formats,rows):
+        # rows past the last checkpoint (or half written) are dropped
+        if 'csv' in formats:
+            with open(self.path+'.csv','r+b') as f:
+                for _ in range(rows+1): # header line + rows
+                    f.readline()
+                f.truncate(f.tell())
+            self.csv = open(self.path+'.csv','a',newline='')
+        if 'npy' in formats:
+            self.npy = open(self.path+'.npy','r+b')
+            self.npy.truncate(self.header_size+rows*self.dtype.itemsize)
+            self.npy.write(self.npy_header(rows))
+            self.npy.flush()
+        self.n_written = rows
+
+    def header_dict(self,n):
+        return "{{'descr': {}, 'fortran_order': False, 'shape': ({},), }}".format(
+            np.lib.format.dtype_to_descr(self.dtype),n)
+
+    def npy_header(self,n):
+        header = self.header_dict(n)
+        header = header + ' '*(self.header_size-11-len(header)) + '\n'
+        return b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1')
+
+    def append(self,*values):
+        values = [np.atleast_1d(np.asarray(v,dtype=float)) for v in values]
+        rows = np.empty(len(values[0]),dtype=self.dtype)
+        for c,v in zip(self.columns,values):
+            rows[c] = v
+        self.pending.append(rows)
+        self.n_pending += len(rows)
+        if self.n_pending >= self.flush_rows or time.monotonic()-self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        rows = np.concatenate(self.pending)
+        self.pending = []
+        self.n_pending = 0
+        if self.csv is not None:
+            index = np.arange(self.n_written,self.n_written+len(rows))
+            table = np.column_stack([index]+[rows[c] for c in self.columns])
+            np.savetxt(self.csv,table,delimiter=',',fmt=['%d']+['%.12g']*len(self.columns))
+            self.csv.flush()
+            os.fsync(self.csv.fileno())
+        if self.npy is not None:
+            self.npy.seek(0,os.SEEK_END)
+            self.npy.write(rows.tobytes())
+            self.npy.flush()
+            self.npy.seek(0)
+            self.npy.write(self.npy_header(self.n_written+len(rows)))
+            self.npy.flush()
+            os.fsync(self.npy.fileno())
+        self.n_written += len(rows)
+
+    def close(self):
+        self.flush()
+        for f in (self.csv,self.npy):
+            if f is not None:
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
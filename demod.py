@@ -0,0 +1,82 @@
+import time
+import numpy as np
+
+# Software lock-in: demodulates blocks of raw timestamped voltage samples (from a
+# buffered voltmeter/digitizer) at several harmonics of the AC current at once.
+# Each harmonic is multiplied with cos/sin references and averaged over windows
+# of a whole number of periods of the fundamental. Such a boxcar has its nulls
+# on every harmonic, so 1w, 2w and 3w do not leak into each other; its noise
+# bandwidth is 1/(2 window). X and Y are rms values like the SR830 reports, for
+#   v = sqrt(2) * sum_n X_n cos(n (w t + phase) + phase_n) - Y_n sin(n (w t + phase) + phase_n)
+# phase is the one of the source current, which runs off its own clock: it is
+# locked to a reference channel sampled with the voltage (the current itself)
+# on every block. phase_n is the reference phase at harmonic n, like the SR830 PHAS.
+#
+#   demodulator = demod.Demodulator(1713,harmonics=(1,2,3),bandwidth=5,phases=(0,90,0))
+#   demodulator.lock(t_raw,i_raw)
+#   t,X,Y = demodulator.add(t_raw,v_raw)   # X, Y: (windows, harmonics)
+
+class Demodulator():
+    def __init__(self,frequency,harmonics=(1,2,3),bandwidth=10.0,phase=0.0,t0=0.0,phases=0.0):
+        self.frequency = frequency
+        self.harmonics = np.asarray(harmonics)
+        # averaging window: the whole number of periods closest to the bandwidth asked for
+        periods = max(int(round(frequency/(2*bandwidth))),1)
+        self.window = periods/frequency
+        self.bandwidth = 1/(2*self.window) # noise bandwidth actually used
+        self.phase = np.radians(phase) # of the fundamental, at t0
+        self.t0 = t0
+        # degree, one for all harmonics or one per harmonic
+        self.phases = np.radians(np.broadcast_to(np.asarray(phases,dtype=float),self.harmonics.shape))
+        self.pending_t = np.empty(0)
+        self.pending_v = np.empty(0)
+        self.started = False
+
+    def lock(self,t,reference):
+        # phase of the fundamental from a block of the reference (the source
+        # current), so that a response in phase with it has Y = 0; a least squares
+        # fit of cos/sin, exact on blocks of any length
+        arg = 2*np.pi*self.frequency*(np.asarray(t)-self.t0)
+        (c,s),*_ = np.linalg.lstsq(np.column_stack([np.cos(arg),np.sin(arg)]),reference,rcond=None)
+        self.phase = np.arctan2(-s,c)
+        return np.degrees(self.phase)
+
+    def add(self,t,v):
+        # returns (t, X, Y) of the windows completed by this block
+        t = np.concatenate([self.pending_t,t])
+        v = np.concatenate([self.pending_v,v])
+        k = len(self.harmonics)
+        if len(t) == 0:
+            return np.empty(0),np.empty((0,k)),np.empty((0,k))
+        index = np.floor((t-self.t0)/self.window).astype(np.int64)
+        if not self.started:
+            # the first window is only partly covered
+            first = np.searchsorted(index,index[0],side='right')
+            t,v,index = t[first:],v[first:],index[first:]
+            self.started = len(t) > 0
+        # the last window may still get samples
+        n = np.searchsorted(index,index[-1]) if len(index) else 0
+        self.pending_t,self.pending_v = t[n:],v[n:]
+        if n == 0:
+            return np.empty(0),np.empty((0,k)),np.empty((0,k))
+        t,v,index = t[:n],v[:n],index[:n]
+        arg = 2*np.pi*self.frequency*(t-self.t0)[:,None]*self.harmonics + self.harmonics*self.phase + self.phases
+        starts = np.flatnonzero(np.r_[True,np.diff(index) != 0])
+        counts = np.diff(np.r_[starts,n])[:,None]
+        X = np.sqrt(2)*np.add.reduceat(v[:,None]*np.cos(arg),starts,axis=0)/counts
+        Y = -np.sqrt(2)*np.add.reduceat(v[:,None]*np.sin(arg),starts,axis=0)/counts
+        return np.add.reduceat(t,starts)/counts[:,0],X,Y
+
+def reader(digitizer,demodulator,interval=0.05):
+    # acquisition reader (see acquisition.Reader) yielding demodulated windows;
+    # digitizer.fetch() -> (t, v, reference), and every block covering a period
+    # re-locks the phase, so that it follows the source clock as it drifts
+    def read():
+        t,v,reference = digitizer.fetch()
+        if len(t) and t[-1]-t[0] >= 1/demodulator.frequency:
+            demodulator.lock(t,reference)
+        t,X,Y = demodulator.add(t,v)
+        if len(t) == 0:
+            time.sleep(interval)
+        return t,X,Y
+    return read
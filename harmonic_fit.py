@@ -0,0 +1,120 @@
+import json
+import numpy as np
+
+# Harmonic decomposition of angle scans,
+#   V(theta) = c0 + sum_n cos_n*cos(n*theta) + sin_n*sin(n*theta),  n = 1..orders
+# fitted to X and Y. RLSFitter updates the fit recursively as (position, X, Y)
+# blocks arrive and reports when the coefficients have settled; fit_series fits
+# many finished runs in one vectorized pass. For the second harmonic the SOT
+# terms are cos_1 (damping-like + thermal) and cos_3 (field-like), for the first
+# harmonic the planar Hall amplitude is sin_2.
+
+def names(orders):
+    return ['c0'] + [f'{kind}_{n}' for n in range(1,orders+1) for kind in ('cos','sin')]
+
+def design(position,orders):
+    # rows [1, cos(theta), sin(theta), ..., cos(N theta), sin(N theta)], position in degree
+    theta = np.radians(np.asarray(position,dtype=float))[:,None]
+    n = np.arange(1,orders+1)
+    columns = np.empty((len(theta),1+2*orders))
+    columns[:,0] = 1
+    columns[:,1::2] = np.cos(n*theta)
+    columns[:,2::2] = np.sin(n*theta)
+    return columns
+
+class RLSFitter():
+    def __init__(self,orders=3,forgetting=1.0,delta=1e6):
+        self.orders = orders
+        self.k = 1+2*orders
+        self.forgetting = forgetting
+        self.theta = np.zeros((self.k,2)) # coefficients of X and Y
+        self.P = delta*np.eye(self.k) # ~ inverse of the normal matrix
+        self.ssr = np.zeros(2) # residual sum of squares of X and Y
+        self.n = 0
+        self.previous = None # coefficients at the last convergence check
+        self.change = np.full(2,np.inf)
+        self.coverage = [np.inf,-np.inf] # angle range seen so far
+
+    def add(self,position,x,y):
+        # block RLS update (matrix inversion lemma for all samples of a block)
+        position = np.asarray(position,dtype=float)
+        if len(position) == 0:
+            return
+        H = design(position,self.orders)
+        Y = np.column_stack([x,y])
+        lam = self.forgetting
+        PH = self.P@H.T
+        S = lam*np.eye(len(H)) + H@PH
+        e = Y - H@self.theta # a priori errors
+        G = np.linalg.solve(S,PH.T).T # gain
+        self.theta = self.theta + G@e
+        self.P = (self.P - G@PH.T)/lam
+        self.P = (self.P+self.P.T)/2
+        self.ssr = lam*self.ssr + np.einsum('ij,ij->j',e,np.linalg.solve(S,e))*lam
+        self.n += len(position)
+        self.coverage = [min(self.coverage[0],position.min()),max(self.coverage[1],position.max())]
+
+    def errors(self):
+        # standard errors of the coefficients, (k, 2)
+        dof = max(self.n-self.k,1)
+        return np.sqrt(np.abs(np.diag(self.P))[:,None]*self.ssr[None,:]/dof)
+
+    def check(self):
+        # coefficient change since the last check, relative to the largest
+        # harmonic amplitude; call at regular intervals
+        scale = np.maximum(np.abs(self.theta[1:]).max(axis=0),1e-15)
+        if self.previous is not None:
+            self.change = np.abs(self.theta-self.previous).max(axis=0)/scale
+        self.previous = self.theta.copy()
+        return self.change
+
+    def converged(self,tolerance,channel=0):
+        # errors and the last change of all coefficients below tolerance times
+        # the largest harmonic amplitude (channel 0: X, 1: Y)
+        scale = max(np.abs(self.theta[1:,channel]).max(),1e-15)
+        return self.change[channel] < tolerance and self.errors()[:,channel].max() < tolerance*scale
+
+    def coefficients(self,channel=0):
+        result = dict(zip(names(self.orders),self.theta[:,channel].tolist()))
+        result.update({name+'_err':float(e) for name,e in zip(names(self.orders),self.errors()[:,channel])})
+        return result
+
+    def curve(self,channel=0,n=361):
+        position = np.linspace(self.coverage[0],self.coverage[1],n)
+        return position,design(position,self.orders)@self.theta[:,channel]
+
+    def text(self,channel=0):
+        c = self.coefficients(channel)
+        return ', '.join('{} {:.3g}+-{:.1g}'.format(name,c[name],c[name+'_err'])
+                         for name in names(self.orders)[1:])
+
+    def results(self):
+        return {'n':self.n,'coverage':[float(c) for c in self.coverage],
+                'x':self.coefficients(0),'y':self.coefficients(1)}
+
+    def save(self,path):
+        # per run summary, path_harmonics.json
+        with open(path+'_harmonics.json','w') as f:
+            json.dump(self.results(),f,indent=1)
+
+def fit_series(positions,xs,orders=3):
+    # least squares fit of many runs in one pass: positions and xs are lists of
+    # arrays (one per run, any lengths); returns coefficients and standard
+    # errors, both (runs, 1+2*orders)
+    lengths = np.array([len(p) for p in positions])
+    H = design(np.concatenate(positions),orders)
+    v = np.concatenate(xs).astype(float)
+    starts = np.concatenate([[0],np.cumsum(lengths)[:-1]])
+    A = np.add.reduceat(H[:,:,None]*H[:,None,:],starts,axis=0) # normal matrices
+    b = np.add.reduceat(H*v[:,None],starts,axis=0)
+    coefficients = np.linalg.solve(A,b[:,:,None])[:,:,0]
+    residuals = v - np.einsum('ij,ij->i',H,np.repeat(coefficients,lengths,axis=0))
+    ssr = np.add.reduceat(residuals**2,starts)
+    dof = np.maximum(lengths-H.shape[1],1)
+    errors = np.sqrt(np.abs(np.diagonal(np.linalg.inv(A),axis1=1,axis2=2))*(ssr/dof)[:,None])
+    return coefficients,errors
+
+def fit_files(paths,orders=3,column='voltage_x (V)'):
+    # fit_series over the .npy files written by data_writer
+    data = [np.load(path) for path in paths]
+    return fit_series([d['position (degree)'] for d in data],[d[column] for d in data],orders)
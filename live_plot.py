@@ -0,0 +1,116 @@
+import multiprocessing as mp
+import queue
+import numpy as np
+
+# Live plotting in a separate process. The acquisition side only puts new
+# points on a queue; matplotlib is imported and run in the render process.
+
+def render(messages,xlabel,ylabels,rects,figsize,interval):
+    import matplotlib.pyplot as plt
+    plt.ion()
+    fig = plt.figure(figsize=figsize)
+    axes,lines = [],[]
+    fits = {} # (axis index, curve index) -> fit line
+    for ylabel,rect in zip(ylabels,rects):
+        ax = fig.add_axes(rect)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        line, = ax.plot([],[],'-o',color='#1f77b4')
+        axes.append(ax)
+        lines.append(line)
+    # preallocated arrays, grown by doubling, so each frame only copies new points
+    n = 0
+    xs = np.empty(1024)
+    ys = np.empty((len(ylabels),1024))
+    running = True
+    while running:
+        changed = False
+        try:
+            message = messages.get(timeout=interval)
+            while True:
+                kind = message[0]
+                if kind == 'data':
+                    x,y = message[1],message[2]
+                    if n+len(x) > len(xs):
+                        size = max(2*len(xs),n+len(x))
+                        grown_x,grown_y = np.empty(size),np.empty((len(ylabels),size))
+                        grown_x[:n],grown_y[:,:n] = xs[:n],ys[:,:n]
+                        xs,ys = grown_x,grown_y
+                    xs[n:n+len(x)] = x
+                    ys[:,n:n+len(x)] = y
+                    n += len(x)
+                    changed = True
+                elif kind == 'fit':
+                    # fitted curves drawn over the data of one axis
+                    index,curves = message[1],message[2]
+                    for i,(x,y) in enumerate(curves):
+                        if (index,i) not in fits:
+                            fits[(index,i)], = axes[index].plot([],[],'-',color='#d62728')
+                        fits[(index,i)].set_data(x,y)
+                elif kind == 'title':
+                    fig.suptitle(message[1],fontsize=9)
+                elif kind == 'save':
+                    fig.savefig(message[1],dpi=message[2])
+                elif kind == 'close':
+                    running = False
+                    break
+                message = messages.get_nowait()
+        except queue.Empty:
+            pass
+        if changed:
+            for ax,line,y in zip(axes,lines,ys):
+                line.set_data(xs[:n],y[:n])
+                ax.relim()
+                ax.autoscale_view()
+        if running:
+            plt.pause(0.01)
+    plt.close(fig)
+
+class LivePlotter():
+    def __init__(self,xlabel,ylabels,rects,figsize=(10,4),interval=0.5):
+        self.messages = mp.Queue()
+        self.process = mp.Process(target=render,args=(self.messages,xlabel,ylabels,rects,figsize,interval),daemon=True)
+        self.process.start()
+
+    def add(self,x,*ys):
+        # copies: the queue pickles later, in its feeder thread, and x may be a
+        # view into sample store memory that is reused by then
+        x = np.atleast_1d(np.array(x,dtype=float))
+        if len(x):
+            self.messages.put(('data',x,np.array([np.atleast_1d(y) for y in ys],dtype=float)))
+
+    def fit(self,index,curves):
+        # curves: [(x, y), ...] drawn on axis index
+        self.messages.put(('fit',index,[(np.asarray(x,dtype=float),np.asarray(y,dtype=float)) for x,y in curves]))
+
+    def title(self,text):
+        self.messages.put(('title',text))
+
+    def save(self,path,dpi=300):
+        self.messages.put(('save',path,dpi))
+
+    def close(self,timeout=60):
+        self.messages.put(('close',))
+        self.process.join(timeout)
+
+class HeadlessPlotter():
+    # same interface, never imports matplotlib
+    def add(self,x,*ys):
+        pass
+
+    def fit(self,index,curves):
+        pass
+
+    def title(self,text):
+        pass
+
+    def save(self,path,dpi=300):
+        pass
+
+    def close(self,timeout=60):
+        pass
+
+def make_plotter(headless,xlabel,ylabels,rects,figsize=(10,4),interval=0.5):
+    if headless:
+        return HeadlessPlotter()
+    return LivePlotter(xlabel,ylabels,rects,figsize,interval)
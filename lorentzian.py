@@ -0,0 +1,210 @@
+import json
+import numpy as np
+
+# Online fit of the ISHE voltage during a spin pumping sweep. Each resonance
+# (+H and -H) is fitted separately with a symmetric + antisymmetric Lorentzian on
+# a linear background,
+#   V = sym*w^2/((H-h_res)^2+w^2) + asym*w*(H-h_res)/((H-h_res)^2+w^2) + offset + slope*(H-h_res)
+# by Levenberg-Marquardt, refitted (warm started) as samples arrive and limited
+# to a window of a few linewidths around the resonance.
+
+PARAMS = ['h_res','width','sym','asym','offset','slope']
+
+def model(h,p):
+    h_res,w,sym,asym,offset,slope = p
+    d = h-h_res
+    den = d**2+w**2
+    return sym*w**2/den + asym*w*d/den + offset + slope*d
+
+def jacobian(h,p):
+    h_res,w,sym,asym,offset,slope = p
+    d = h-h_res
+    den = d**2+w**2
+    ls = w**2/den # symmetric
+    la = w*d/den # antisymmetric
+    # derivatives with respect to h_res, w, sym, asym, offset, slope
+    dls_dd = -2*d*w**2/den**2
+    dla_dd = w*(w**2-d**2)/den**2
+    dls_dw = 2*w*d**2/den**2
+    dla_dw = d*(d**2-w**2)/den**2
+    return np.column_stack([-(sym*dls_dd+asym*dla_dd)-slope,sym*dls_dw+asym*dla_dw,ls,la,np.ones_like(h),d])
+
+def levenberg_marquardt(h,v,p,max_iter=50,tol=1e-9):
+    # returns parameters, covariance and reduced chi^2
+    p = np.array(p,dtype=float)
+    r = v-model(h,p)
+    chi2 = r@r
+    lam = 1e-3
+    for _ in range(max_iter):
+        J = jacobian(h,p)
+        A = J.T@J
+        g = J.T@r
+        try:
+            step = np.linalg.solve(A+lam*np.diag(np.diag(A)),g)
+        except np.linalg.LinAlgError:
+            lam *= 10
+            continue
+        p_new = p+step
+        p_new[1] = np.abs(p_new[1])
+        r_new = v-model(h,p_new)
+        chi2_new = r_new@r_new
+        if chi2_new < chi2:
+            converged = chi2-chi2_new <= tol*chi2
+            p,r,chi2 = p_new,r_new,chi2_new
+            lam = max(lam/10,1e-12)
+            if converged:
+                break
+        else:
+            lam *= 10
+            if lam > 1e12:
+                break
+    J = jacobian(h,p)
+    dof = max(len(h)-len(p),1)
+    try:
+        cov = np.linalg.inv(J.T@J)*chi2/dof
+    except np.linalg.LinAlgError:
+        cov = np.full((len(p),len(p)),np.inf)
+    return p,cov,chi2/dof
+
+def initial_guess(h,v,min_snr=8):
+    # None until a peak stands out of the noise and the sweep has passed it
+    if len(v) < 10:
+        return None
+    offset = np.median(v)
+    noise = 1.4826*np.median(np.abs(np.diff(v)))/np.sqrt(2)
+    i = np.argmax(np.abs(v-offset))
+    height = v[i]-offset
+    if np.abs(height) < min_snr*max(noise,1e-15):
+        return None
+    above = np.abs(v-offset) >= np.abs(height)/2
+    if above[np.argmin(h)] or above[np.argmax(h)]:
+        return None # not bracketed by points below half maximum yet
+    width = max((h[above].max()-h[above].min())/2,np.abs(np.median(np.diff(h)))*2)
+    return [h[i],width,height,0.0,offset,0.0]
+
+class LorentzianFitter():
+    # one resonance: the samples with sign(field) == sign
+    def __init__(self,sign,window=8,min_points=30):
+        self.sign = sign
+        self.window = window # fitted range in linewidths around h_res
+        self.min_points = min_points
+        self.h = []
+        self.v = []
+        self.p = None
+        self.cov = None
+        self.chi2 = None
+
+    def add(self,field,x):
+        mask = np.sign(field) == self.sign
+        if mask.any():
+            self.h.append(np.asarray(field,dtype=float)[mask])
+            self.v.append(np.asarray(x,dtype=float)[mask])
+
+    def data(self):
+        if len(self.h) > 1:
+            self.h,self.v = [np.concatenate(self.h)],[np.concatenate(self.v)]
+        return (self.h[0],self.v[0]) if self.h else (np.empty(0),np.empty(0))
+
+    def update(self):
+        h,v = self.data()
+        p = self.p
+        if p is None:
+            p = initial_guess(h,v)
+            if p is None:
+                return None
+        mask = np.abs(h-p[0]) <= self.window*p[1]
+        if mask.sum() < self.min_points:
+            return None
+        self.p,self.cov,self.chi2 = levenberg_marquardt(h[mask],v[mask],p)
+        if not h[mask].min() < self.p[0] < h[mask].max() or self.p[1] > np.ptp(h[mask]):
+            # diverged: start again from a fresh guess with the next samples
+            self.p,self.cov,self.chi2 = None,None,None
+        return self.p
+
+    def errors(self):
+        return np.sqrt(np.abs(np.diag(self.cov)))
+
+    def covered(self,field,direction):
+        # the sweep (direction +1 up, -1 down) has passed the whole fit window
+        if self.p is None or direction == 0:
+            return False
+        return direction*(field-self.p[0]) > self.window*self.p[1]
+
+    def converged(self,tolerance):
+        # uncertainty of h_res, width and sym below tolerance (relative to the
+        # linewidth for h_res and width, to |sym| for sym)
+        if self.p is None:
+            return False
+        err = self.errors()
+        w = self.p[1]
+        return err[0] < tolerance*w and err[1] < tolerance*w and err[2] < tolerance*np.abs(self.p[2])
+
+    def result(self):
+        if self.p is None:
+            return None
+        result = {name:float(value) for name,value in zip(PARAMS,self.p)}
+        result.update({name+'_err':float(e) for name,e in zip(PARAMS,self.errors())})
+        result['chi2_reduced'] = float(self.chi2)
+        result['n'] = int((np.abs(self.data()[0]-self.p[0]) <= self.window*self.p[1]).sum())
+        return result
+
+class SweepFitter():
+    # both resonances of a +H -> -H sweep, refitted every refit_points samples
+    def __init__(self,signs=(1,-1),refit_points=50,window=6):
+        self.fitters = [LorentzianFitter(sign,window) for sign in signs]
+        self.refit_points = refit_points
+        self.pending = 0
+        self.field = None
+        self.direction = 0
+
+    def add(self,field,x):
+        if len(field) == 0:
+            return False
+        for fitter in self.fitters:
+            fitter.add(field,x)
+        if self.field is not None and field[-1] != self.field:
+            self.direction = np.sign(field[-1]-self.field)
+        self.field = field[-1]
+        self.pending += len(field)
+        if self.pending < self.refit_points:
+            return False
+        self.pending = 0
+        for fitter in self.fitters:
+            if not fitter.covered(self.field,self.direction) or fitter.chi2 is None:
+                fitter.update()
+        return True
+
+    def done(self,tolerance):
+        # every resonance fitted to tolerance and swept past: the rest of the
+        # sweep adds nothing to the fit
+        return all(f.covered(self.field,self.direction) and f.converged(tolerance) for f in self.fitters)
+
+    def curves(self,n=200):
+        # (field, fitted V) of each resonance for the plot
+        curves = []
+        for f in self.fitters:
+            if f.p is not None:
+                h = f.p[0]+np.linspace(-f.window,f.window,n)*f.p[1]
+                curves.append((h,model(h,f.p)))
+        return curves
+
+    def text(self):
+        parts = []
+        for f in self.fitters:
+            r = f.result()
+            if r is not None:
+                parts.append('H_res {:.1f}+-{:.1f} Oe, dH {:.1f}+-{:.1f} Oe, S {:.3g}, A {:.3g}'.format(
+                    r['h_res'],r['h_res_err'],r['width'],r['width_err'],r['sym'],r['asym']))
+        return '; '.join(parts)
+
+    def resonance(self):
+        fields = [np.abs(f.p[0]) for f in self.fitters if f.p is not None]
+        return float(np.mean(fields)) if fields else None
+
+    def results(self):
+        return {'{:+d}'.format(f.sign):f.result() for f in self.fitters}
+
+    def save(self,path):
+        # per run summary, path_fit.json
+        with open(path+'_fit.json','w') as file:
+            json.dump(self.results(),file,indent=1)
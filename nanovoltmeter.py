@@ -0,0 +1,70 @@
+import numpy as np
+
+# Burst readout for the Keithley 2182A: all readings of a set point come back in
+# one :READ? (or :TRAC:DATA?) transaction and are decoded into a NumPy array.
+
+# ASCII responses on our bus arrive with some characters shifted ('=' for '-',
+# ';' for '+', 'U' for 'E', '>' for '.', '<' for ',')
+FIX_RESPONSE = str.maketrans({'=':'-',';':'+','U':'E','>':'.','<':',','\x1a':None})
+
+def parse_ascii(response):
+    return np.array(response.translate(FIX_RESPONSE).strip().split(','),dtype=float)
+
+class K2182Burst():
+    def __init__(self,k2182,count=10,binary=True,nplc=5,line_freq=50):
+        self.k2182 = k2182
+        self.count = count
+        self.binary = binary
+        self.nplc = nplc
+        self.line_freq = line_freq
+
+    def configure(self):
+        self.k2182.write(f":SAMP:COUN {self.count}")
+        self.k2182.write(f":SENS:VOLT:NPLC {self.nplc}")
+        if self.binary:
+            self.k2182.write(":FORM:DATA SRE") # IEEE754 single precision
+            self.k2182.write(":FORM:BORD SWAP") # little endian
+        else:
+            self.k2182.write(":FORM:DATA ASC")
+
+    def reset(self):
+        self.k2182.write(":FORM:DATA ASC")
+        self.k2182.write(":SAMP:COUN 1")
+
+    def fetch(self,command):
+        if self.binary:
+            return self.k2182.query_binary_values(command,datatype='f',is_big_endian=False,container=np.array).astype(float)
+        return parse_ascii(self.k2182.query(command))
+
+    def burst_time(self):
+        # s for count readings; autozero takes about as long as the reading itself
+        return self.count*2*self.nplc/self.line_freq
+
+    def read(self):
+        # one trigger, count readings; the answer only comes after the last one
+        timeout = self.k2182.timeout # ms, whatever the resource was set to
+        self.k2182.timeout = timeout + 1500*self.burst_time()
+        try:
+            return self.fetch(":READ?")
+        finally:
+            self.k2182.timeout = timeout
+
+    def trace(self):
+        # contents of the reading buffer
+        return self.fetch(":TRAC:DATA?")
+
+def stats(readings,n_sigma=3):
+    # per set point statistics along the last axis; outliers are rejected by
+    # their distance from the median in units of the (MAD based) robust sigma
+    readings = np.asarray(readings,dtype=float)
+    median = np.median(readings,axis=-1,keepdims=True)
+    sigma = 1.4826*np.median(np.abs(readings-median),axis=-1,keepdims=True)
+    keep = np.abs(readings-median) <= n_sigma*np.where(sigma > 0,sigma,np.inf)
+    n_kept = keep.sum(axis=-1)
+    mean_clipped = np.where(keep,readings,0).sum(axis=-1)/n_kept
+    std_clipped = np.sqrt(np.where(keep,(readings-mean_clipped[...,None])**2,0).sum(axis=-1)/np.maximum(n_kept-1,1))
+    return {'mean':readings.mean(axis=-1),
+            'std':readings.std(axis=-1,ddof=1) if readings.shape[-1] > 1 else np.zeros(readings.shape[:-1]),
+            'mean_clipped':mean_clipped,
+            'std_clipped':std_clipped,
+            'n_kept':n_kept}
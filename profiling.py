@@ -0,0 +1,126 @@
+import re
+import json
+import time
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+# Timing of every instrument call and every deliberate wait, grouped by
+# instrument and command, plus wall time per phase (settle, acquire, plot,
+# save). Resources are wrapped with Profiler.wrap(); the report is printed and
+# saved next to the data at the end of a run.
+
+HISTOGRAM_BINS = [0,1e-3,1e-2,1e-1,1,np.inf]
+HISTOGRAM_LABELS = ['<1ms','1-10ms','10-100ms','0.1-1s','>1s']
+
+def command_key(command):
+    # 'SNAP?1,2' -> 'SNAP?', ':SOUR:CURR:TRIG 0.001' -> ':SOUR:CURR:TRIG'
+    return re.match(r'[^\s?]*\??',command.strip()).group(0)
+
+class Profiled():
+    # transparent proxy that times every method call of the wrapped object
+    def __init__(self,target,name,profiler):
+        object.__setattr__(self,'_target',target)
+        object.__setattr__(self,'_name',name)
+        object.__setattr__(self,'_profiler',profiler)
+
+    def __getattr__(self,attr):
+        value = getattr(self._target,attr)
+        if not callable(value):
+            return value
+        def call(*args,**kwargs):
+            key = attr
+            if args and isinstance(args[0],str):
+                key = '{} {}'.format(attr,command_key(args[0]))
+            t = time.perf_counter()
+            try:
+                return value(*args,**kwargs)
+            finally:
+                self._profiler.add(self._name,key,time.perf_counter()-t)
+        return call
+
+    def __setattr__(self,attr,value):
+        setattr(self._target,attr,value)
+
+class Profiler():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.calls = {} # (instrument, command) -> [durations]
+        self.phases = {}
+        self.points = 0
+        self.t_start = time.perf_counter()
+
+    def wrap(self,target,name):
+        return Profiled(target,name,self)
+
+    def add(self,instrument,command,duration):
+        with self.lock:
+            self.calls.setdefault((instrument,command),[]).append(duration)
+
+    def sleep(self,seconds,label='time.sleep'):
+        t = time.perf_counter()
+        time.sleep(seconds)
+        self.add('wait',label,time.perf_counter()-t)
+
+    @contextmanager
+    def phase(self,name):
+        # phases are exclusive: a nested phase (e.g. plot inside acquire) pauses
+        # the enclosing one, so the phase times add up to the wall time
+        stack = self.local.__dict__.setdefault('stack',[])
+        now = time.perf_counter()
+        if stack:
+            self.add_phase(stack[-1][0],now-stack[-1][1])
+        stack.append([name,now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            name,t = stack.pop()
+            self.add_phase(name,now-t)
+            if stack:
+                stack[-1][1] = now
+
+    def add_phase(self,name,duration):
+        with self.lock:
+            self.phases[name] = self.phases.get(name,0) + duration
+
+    def count(self,n):
+        with self.lock:
+            self.points += n
+
+    def summary(self):
+        wall = time.perf_counter()-self.t_start
+        with self.lock:
+            calls = {k:np.array(v) for k,v in self.calls.items()}
+            phases = dict(self.phases)
+            points = self.points
+        rows = []
+        for (instrument,command),d in sorted(calls.items(),key=lambda kv:-kv[1].sum()):
+            rows.append({'instrument':instrument,'command':command,'count':len(d),'total':d.sum(),
+                         'mean':d.mean(),'p50':np.median(d),'p95':np.percentile(d,95),'max':d.max(),
+                         'histogram':dict(zip(HISTOGRAM_LABELS,np.histogram(d,HISTOGRAM_BINS)[0].tolist()))})
+        return {'wall':wall,'points':points,'points_per_s':points/wall if wall > 0 else 0,
+                'phases':phases,'calls':rows}
+
+    def report(self):
+        s = self.summary()
+        lines = ['timing: {:.1f} s wall, {} points, {:.2f} points/s'.format(s['wall'],s['points'],s['points_per_s'])]
+        for name,t in s['phases'].items():
+            lines.append('  {:<10s} {:9.2f} s  {:5.1f} %'.format(name,t,100*t/s['wall']))
+        lines.append('  {:<10s} {:<28s} {:>7s} {:>9s} {:>9s} {:>9s} {:>9s}  {}'.format(
+            'instrument','command','count','total s','mean ms','p95 ms','max ms',' '.join(HISTOGRAM_LABELS)))
+        for r in s['calls']:
+            lines.append('  {:<10s} {:<28s} {:>7d} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}  {}'.format(
+                r['instrument'],r['command'][:28],r['count'],r['total'],1e3*r['mean'],1e3*r['p95'],1e3*r['max'],
+                ' '.join(str(n) for n in r['histogram'].values())))
+        return '\n'.join(lines)
+
+    def save(self,path):
+        # path without extension: writes path_timing.txt and path_timing.json
+        text = self.report()
+        print(text)
+        with open(path+'_timing.txt','w') as f:
+            f.write(text+'\n')
+        with open(path+'_timing.json','w') as f:
+            json.dump(self.summary(),f,indent=1,default=float)
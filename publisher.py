@@ -0,0 +1,164 @@
+import sys
+import json
+import time
+import socket
+import threading
+import collections
+import numpy as np
+
+# Live data stream for any number of viewers: a TCP server on localhost sending
+# one JSON object per line,
+#   {"type": "data", "run": ..., "t": ..., "columns": {"field": [...], "x": [...], ...}}
+#   {"type": "status", "run": ..., "t": ..., "state": "settling", "quantity": "field", "target": ..., "eta": ...}
+# publish() only appends to a bounded queue, encoding and sending happen in
+# background threads. Every queue drops its oldest messages when full, so a
+# slow or stalled viewer never holds up the measurement (it only loses data).
+#
+#   python publisher.py [host:]port      # print the stream of a running measurement
+
+DEFAULT_PORT = 5555
+
+class Subscriber(threading.Thread):
+    def __init__(self,connection,maxlen):
+        super().__init__(daemon=True)
+        self.connection = connection
+        self.lines = collections.deque(maxlen=maxlen)
+        self.ready = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self,line):
+        with self.ready:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+            self.lines.append(line)
+            self.ready.notify()
+
+    def run(self):
+        try:
+            while True:
+                with self.ready:
+                    while not self.lines:
+                        self.ready.wait()
+                    lines = list(self.lines)
+                    self.lines.clear()
+                self.connection.sendall(b''.join(lines))
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            self.connection.close()
+
+class Publisher():
+    def __init__(self,port=DEFAULT_PORT,host='127.0.0.1',maxlen=1000,status_interval=0.5):
+        self.server = socket.create_server((host,port))
+        self.port = self.server.getsockname()[1]
+        self.maxlen = maxlen # messages per queue
+        self.status_interval = status_interval # s between status messages of one quantity
+        self.messages = collections.deque(maxlen=maxlen)
+        self.ready = threading.Condition()
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.run = None
+        self.sent = {} # quantity -> (time, state) of the last status message
+        self.last_status = {} # quantity -> last encoded status message, sent to new viewers
+        self.dropped = 0
+        threading.Thread(target=self.accept,daemon=True).start()
+        threading.Thread(target=self.dispatch,daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                connection,_ = self.server.accept()
+            except OSError:
+                return
+            subscriber = Subscriber(connection,self.maxlen)
+            with self.lock:
+                for line in self.last_status.values():
+                    subscriber.put(line)
+                self.subscribers.append(subscriber)
+            subscriber.start()
+
+    def publish(self,message):
+        with self.ready:
+            if len(self.messages) == self.messages.maxlen:
+                self.dropped += 1
+            self.messages.append(message)
+            self.ready.notify()
+
+    def data(self,block):
+        # block: new rows of a sample_store (copied, the store reuses its memory)
+        if len(block):
+            self.publish({'type':'data','run':self.run,'t':time.time(),'block':block.copy()})
+
+    def status(self,state,quantity=None,**info):
+        # throttled per quantity, except when the state changes
+        now = time.monotonic()
+        last = self.sent.get(quantity)
+        if last is not None and now-last[0] < self.status_interval and last[1] == state:
+            return
+        self.sent[quantity] = (now,state)
+        self.publish({'type':'status','run':self.run,'t':time.time(),'state':state,'quantity':quantity,**info})
+
+    def settle_reporter(self,quantity):
+        # report callback for settle.Settle
+        def report(target,value,state,eta):
+            self.status('settling' if state != 'settled' else 'settled',quantity,target=target,value=value,
+                        settle_state=state,eta=eta)
+        return report
+
+    def encode(self,message):
+        if message['type'] == 'data':
+            block = message.pop('block')
+            message['columns'] = {name:block[name].tolist() for name in block.dtype.names
+                                  if not np.isnan(block[name]).all()}
+        return (json.dumps(message,default=float)+'\n').encode()
+
+    def dispatch(self):
+        while True:
+            with self.ready:
+                while not self.messages:
+                    self.ready.wait()
+                message = self.messages.popleft()
+            line = self.encode(message)
+            with self.lock:
+                if message['type'] == 'status':
+                    self.last_status[message['quantity']] = line
+                self.subscribers = [s for s in self.subscribers if not s.closed]
+                for subscriber in self.subscribers:
+                    subscriber.put(line)
+
+    def close(self):
+        self.server.close()
+
+# one publisher per port, shared by all runs of a process
+PUBLISHERS = {}
+
+def open_publisher(publish):
+    # publish argument of the measurement classes: True for DEFAULT_PORT, a port
+    # number, a Publisher, or False/None for none
+    if publish is True:
+        publish = DEFAULT_PORT
+    if isinstance(publish,int) and not isinstance(publish,bool):
+        if publish not in PUBLISHERS:
+            PUBLISHERS[publish] = Publisher(publish)
+        return PUBLISHERS[publish]
+    return publish or None
+
+def subscribe(host='127.0.0.1',port=DEFAULT_PORT):
+    # yields the messages of a publisher until it goes away
+    with socket.create_connection((host,port)) as connection:
+        for line in connection.makefile('r'):
+            yield json.loads(line)
+
+if __name__ == "__main__":
+    address = sys.argv[1] if len(sys.argv) > 1 else str(DEFAULT_PORT)
+    host,_,port = address.rpartition(':')
+    for message in subscribe(host or '127.0.0.1',int(port)):
+        if message['type'] == 'data':
+            columns = message['columns']
+            print('{} data {} points: {}'.format(message['run'],len(columns.get('t',[])),
+                  ', '.join('{} {:.4g}'.format(k,v[-1]) for k,v in columns.items() if k != 't')))
+        else:
+            print('{} {}'.format(message['run'],', '.join('{} {}'.format(k,v) for k,v in message.items()
+                                                          if k not in ('type','run','t'))))
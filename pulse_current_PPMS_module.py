@@ -1,187 +1,313 @@
-import pyvisa
 import time
-import pandas as pd
-import matplotlib.pyplot as plt
+import contextlib
 import os,sys
 import numpy as np
-from labdrivers.quantumdesign import qdinstrument
-from matplotlib.animation import FuncAnimation
-
-os.chdir(sys.path[0])
+import live_plot
+import data_writer
+import sample_store
+import settle
+import async_instruments
+import profiling
+import nanovoltmeter
+import catalog as run_catalog
+import publisher
+import telemetry as telemetry_sampler
 
 # ---------------------------------------------------------
 # ---------------------------------------------------------
 
+# per set point statistics of the 2182A readings saved next to I, V, R
+STATS_KEYS = ['std','mean_clipped','std_clipped','n_kept']
+STATS_COLUMNS = ['V_std','V_clipped','V_std_clipped','n_kept']
+
 class Current_swtiching():
-    def __init__(self,path_name,temperature0,sat_field,field0,current_list,width,mear_curr,set_temp,wating_time,ppms):
+    def __init__(self,path_name,temperature0,sat_field,field0,current_list,width,mear_curr,set_temp,wating_time,ppms=None,headless=False,sequenced=False,num_readings=10,binary=True,session=None,defer=None,catalog=True,checkpoint=None,publish=None,telemetry=None):
     ## required input：
+        # run parameters for the catalog
+        self.params = {k:v for k,v in locals().items() if k not in ('self','ppms','session','defer','catalog','checkpoint','publish')}
         self.path_name = path_name
+        # runs are registered in <path_name>/catalog.sqlite unless catalog=False
+        self.catalog = run_catalog.open_catalog(catalog,path_name)
+        # samples and run status go to a local stream for live viewers (see publisher.py)
+        self.publisher = publisher.open_publisher(publish)
+        # times every instrument call and wait of this run
+        self.profiler = profiling.Profiler()
         self.maxcurrent = current_list[-1]
         self.mear_curr = mear_curr #mA
         self.temperature0 = temperature0
         self.field0 = field0
+        self.width = width #ms
 
-        # Initialize the VISA resource manager
-        rm = pyvisa.ResourceManager()
+        # Initialize the VISA resource manager (or reuse the open ones of a session)
+        self.session = session
+        if session is not None:
+            rm = session
+        else:
+            import pyvisa
+            rm = pyvisa.ResourceManager()
 
         # Open connections
         print('start to connect 2901 and 2182')
-        self.k2901 = rm.open_resource('GPIB1::17::INSTR') #B2901A
-        self.k2182 = rm.open_resource('GPIB0::7::INSTR')  #2182A
-        # Configure
-        self.set_config(mear_curr,width)
+        self.k2901 = self.profiler.wrap(rm.open_resource('GPIB1::17::INSTR'),'k2901') #B2901A
+        self.k2182 = self.profiler.wrap(rm.open_resource('GPIB0::7::INSTR'),'k2182')  #2182A
+        self.burst = nanovoltmeter.K2182Burst(self.k2182,num_readings,binary)
         print('2901 and 2182 connected')
 
         #Connect to PPMS
         print('start to connect DynaCool')
-        self.ppms=ppms
+        if ppms is None and session is not None:
+            ppms = session.ppms
+        elif ppms is None:
+            from labdrivers.quantumdesign import qdinstrument
+            ppms = qdinstrument.QdInstrument('DynaCool','192.168.0.4')
+        self.ppms=self.profiler.wrap(ppms,'ppms')
         print('connection established')
 
+        # Configure while the temperature settles
+        jobs = []
+        if session is None or session.needs_config('pulse_current',(mear_curr,width)):
+            jobs.append(async_instruments.configure(self.config_commands(mear_curr,width)))
         if set_temp:
-            self.set_temp(temperature0)
-            for i in range(wating_time):
-                print('waiting temperature stable, remaining time {} s'.format(wating_time-i))
-                time.sleep(1)
+            jobs.append(async_instruments.on_ppms(self.set_temp,temperature0,hold=wating_time))
+        async_instruments.run(*jobs)
+        # an interrupted run (see checkpoint.py) continues after its last saved set
+        # point; one row per set point, so rows is the index to continue from
+        self.checkpoint = checkpoint
+        self.resume = checkpoint.resume() if checkpoint is not None else {}
+        if checkpoint is not None and set_temp:
+            checkpoint.settled(temperature0)
 
-        self.set_field(sat_field)
-        time.sleep(2)
+        if not self.resume.get('rows'):
+            self.set_field(sat_field)
+            self.profiler.sleep(2)
         self.set_field(field0)
 
         self.k2901.write(":OUTP ON")  # Turn on the output
-        time.sleep(1)
+        self.profiler.sleep(1)
 
-        # Prepare for plotting
-        plt.ion()  # Turn on interactive mode
+        # with telemetry temperature, field, position and chamber status are read
+        # in the background (every telemetry s) and saved with every point
+        self.telemetry = telemetry_sampler.open_telemetry(telemetry,self.ppms)
+        self.columns = ['I','V','R']+STATS_COLUMNS+([telemetry_sampler.COLUMNS[c] for c in self.telemetry.channels]
+                                                    if self.telemetry is not None else [])
 
-        self.animating = True
-        self.fig = plt.figure(figsize=(5,4))
-        self.ax1 = self.fig.add_axes([0.2,0.2,0.6,0.6])
-        self.ax1.set_xlabel("Current (mA)")
-        self.ax1.set_ylabel("Resistance (ohm)")
-        self.currents = []
-        self.voltages = []
-        self.resistances = []
+        # Prepare for plotting
+        self.store = sample_store.SampleStore(maxlen=sample_store.MAXLEN,dtype=sample_store.sample_dtype(
+            ['t','current','x']+(self.telemetry.channels if self.telemetry is not None else [])))
+        self.plotter = live_plot.make_plotter(headless,"Current (mA)",["Resistance (ohm)"],[[0.2,0.2,0.6,0.6]],figsize=(5,4))
 
-        self.test_current()
-        self.scan_current(current_list)
+        with self.profiler.phase('acquire'),self.telemetry or contextlib.nullcontext():
+            self.test_current()
+            if self.resume.get('rows'):
+                # instead of saturating again, restore the state the last completed pulse left
+                self.k2901.write(f":SOUR:CURR:TRIG {current_list[self.resume['rows']-1] * 1e-3}")
+                self.k2901.write(":INIT")
+                self.profiler.sleep(1)
+            if sequenced:
+                self.scan_current_sequenced(current_list,num_readings)
+            else:
+                self.scan_current(current_list)
 
         # Finish plotting
         print('measurement compeleted')
-        self.animating = False 
-        plt.ioff()
-        plt.close()
-        plt.clf()
         self.k2901.write(":OUTP OFF")
+        if defer is not None:
+            defer(self.finish)
+        else:
+            self.finish()
+
+        # Close the connections (a session keeps them open for the next run)
+        if session is None:
+            self.k2901.close()
+            self.k2182.close()
 
-        # Close the connections
-        self.k2901.close()
-        self.k2182.close()
+    @staticmethod
+    def output_name(temperature0,field0,current_list,width,mear_curr,**params):
+        # data file name without extension; the scheduler checks that runs differ in it
+        return 'temperature_{}K_field_{}Oe_max_current_{}mA_width_{}ms_probe_{}mA'.format(
+            temperature0,field0,current_list[-1],width,mear_curr)
+
+    def finish(self):
+        # Saving and closing the plot. A pipelined scheduler runs this in the
+        # background while the next run already ramps temperature/field.
+        with self.profiler.phase('save'):
+            self.writer.close()
+            if self.catalog is not None:
+                run_catalog.register(self.catalog,'pulse_current',self,self.config_commands(self.mear_curr,self.width))
+        with self.profiler.phase('plot'):
+            self.plotter.close()
+        self.profiler.save(self.path_name + self.file_name)
+
+    def config_commands(self,mear_curr,width):
+        k2182 = []
+        k2901 = []
+        k2182.append('*RST')
+        k2901.append('*RST')
+        k2901.append(":SOUR:FUNC:MODE CURR")
+        k2901.append(":SOUR:FUNC PULS")
+        k2901.append(f":SOUR:CURR {mear_curr * 1e-3}")
+        k2901.append(f":SOURCE:PULS:WIDTH {width * 1e-3}")  # Set triggered level
+        k2901.append(":SENS:VOLT:PROT 42")
+
+        k2182.append(":SENS:FUNC 'VOLT:DC'")
+        k2182.append(":SENS:VOLT:DC:RANGE 10") # 10 mV minimal range
+
+        return [(self.k2182,k2182),(self.k2901,k2901)]
 
     def set_config(self,mear_curr,width):
-        self.k2182.write('*RST')
-        self.k2901.write('*RST')
-        self.k2901.write(":SOUR:FUNC:MODE CURR")
-        self.k2901.write(":SOUR:FUNC PULS")
-        self.k2901.write(f":SOUR:CURR {mear_curr * 1e-3}")
-        self.k2901.write(f":SOURCE:PULS:WIDTH {width * 1e-3}")  # Set triggered level
-        self.k2901.write(":SENS:VOLT:PROT 42")
-
-        self.k2182.write(":SENS:FUNC 'VOLT:DC'")
-        self.k2182.write(":SENS:VOLT:DC:RANGE 10") # 10 mV minimal range
-
-    def set_temp(self,temperature0,t_rate=12):
-        print('start to set temperature to {}'.format(temperature0))
-        self.ppms.setTemperature(temperature0,t_rate)
-        time.sleep(0.5)
-        _, temperature, status = self.ppms.getTemperature()
-        while status != 1: #1 stable 6 Tracking
-            _, temperature, status = self.ppms.getTemperature()
-            print(temperature,status)
-            time.sleep(1)
-            pass
-        print('temperature set successfully')
+        # the instruments sit on different GPIB boards and are configured concurrently
+        async_instruments.run(async_instruments.configure(self.config_commands(mear_curr,width)))
+
+    def set_temp(self,temperature0,t_rate=12,hold=0):
+        # hold: seconds the temperature must stay stable before returning
+        with self.profiler.phase('settle'):
+            settle.set_temperature(self.ppms,temperature0,t_rate,hold=hold,report=self.reporter('temperature'))
+
+    def reporter(self,quantity):
+        # settle progress for the live stream
+        return self.publisher.settle_reporter(quantity) if self.publisher is not None else None
 
     def set_field(self,field0,h_rate=200):
-        print('start to set field to {}'.format(field0))
-        self.ppms.setField(field0,h_rate)
-        time.sleep(0.5)
-        _,field, status = self.ppms.getField()
-        while status != 4 or np.abs(field-field0)>1: 
-            _,field, status = self.ppms.getField()
-            print(field,status)
-            time.sleep(1)
-            pass
-        print('field set successfully')
-
-    def extract_voltage(self,response):
-        # You can customize this function if the output format changes.
-        #print(response)
-        response = response.replace('=','-')
-        response = response.replace(';','+')
-        response = response.replace('U','E')
-        response = response.replace('>','.')
-        response = response.replace('\x1a','')
-        #print(response)
-        return(float(response))
+        with self.profiler.phase('settle'):
+            settle.set_field(self.ppms,field0,h_rate,report=self.reporter('field'))
 
     def test_current(self):
         print('test current')
         for i in range(3):
             self.k2901.write(f":SOUR:CURR:TRIG {0}")  # Set triggered level
             self.k2901.write(":INIT")
-            time.sleep(1)  # Wait for stabilization
+            self.profiler.sleep(1)  # Wait for stabilization
             self.k2182.query(":READ?")
-            time.sleep(0.1)  # Wait for stabilization
+            self.profiler.sleep(0.1)  # Wait for stabilization
 
     def scan_current(self,current_list):
         print('start to scan current')
-        time.sleep(0.1)
-        def animate(i):
-            if not self.animating:
-                ani.event_source.stop()  # Stop the animation
-                return
-            self.ax1.clear()
-            self.ax1.plot(self.currents, self.resistances, '-o', color='#1f77b4')
-        # Start the animation
-        ani = FuncAnimation(self.fig, animate, interval=3000, cache_frame_data=False)  # Update every 2000 ms
-
-        for current in current_list:  # In mA
+        file_name = self.output_name(self.temperature0,self.field0,[self.maxcurrent],self.width,self.mear_curr)
+        self.file_name = file_name
+        self.writer = data_writer.StreamWriter(self.path_name+file_name,self.columns,flush_rows=1,
+                                               resume_rows=self.resume.get('rows'))
+        if self.publisher is not None:
+            self.publisher.run = file_name
+        self.started = (time.monotonic(),self.writer.n_written,len(current_list)) # for the ETA
+        self.burst.configure()
+        self.profiler.sleep(0.1)
+        for current in current_list[self.resume.get('rows',0):]:  # In mA
             print('appiled pulsed current {} mA'.format(current))
             # Set the pulse current level
             self.k2901.write(f":SOUR:CURR:TRIG {current * 1e-3}")  # Set triggered level
             self.k2901.write(":INIT")
 
-            time.sleep(1)  # Wait for stabilization
+            self.profiler.sleep(1)  # Wait for stabilization
             
-            voltage = 0
-            num = 10
-            for i in range(num):
-                response = self.k2182.query(":READ?")
-                voltage += self.extract_voltage(response)
-                time.sleep(0.01) 
-            voltage = voltage/num
-            time.sleep(0.1)  # Wait for stabilization
-
-            # Append data to lists
-            self.currents.append(current)
-            self.voltages.append(voltage)
-            self.resistances.append(voltage/(self.mear_curr*1e-3))
-
-            plt.pause(0.1)  # Short pause to update plot
-            time.sleep(0.1)  # Wait for stabilization
-
-        df = pd.DataFrame({'I':self.currents,'V':self.voltages,'R':self.resistances})
-        file_name = 'temperature_{}K_field_{}Oe_max_current_{}mA'.format(self.temperature0,self.field0,self.maxcurrent)
-        df.to_csv(self.path_name+file_name+'.csv')
-        plt.savefig(self.path_name+file_name+'.png',dpi=300)
+            # all readings of this set point in one transaction
+            stats = nanovoltmeter.stats(self.burst.read())
+            self.profiler.sleep(0.1)  # Wait for stabilization
+
+            self.record(stats,t=time.monotonic(),current=current,x=stats['mean'])
+            self.profiler.sleep(0.1)  # Wait for stabilization
+
+        self.burst.reset()
+        self.writer.flush()
+        self.plotter.save(self.path_name+file_name+'.png',dpi=300)
+
+    def scan_current_sequenced(self,current_list,num=10,nplc=5,line_freq=50):
+        # The B2901A runs current_list as a list sweep on its own timer and sends a
+        # trigger on EXT1 after every pulse; the 2182A (trigger link input) takes
+        # num readings per trigger into its buffer, which is read in one transfer.
+        print('start to scan current (sequenced)')
+        file_name = self.output_name(self.temperature0,self.field0,[self.maxcurrent],self.width,self.mear_curr)
+        self.file_name = file_name
+        self.writer = data_writer.StreamWriter(self.path_name+file_name,self.columns,flush_rows=1,
+                                               resume_rows=self.resume.get('rows'))
+        if self.publisher is not None:
+            self.publisher.run = file_name
+        self.started = (time.monotonic(),self.writer.n_written,len(current_list)) # for the ETA
+        self.burst.count = num
+        self.burst.nplc,self.burst.line_freq = nplc,line_freq
+        self.burst.configure()
+        current_list = list(current_list)
+        # the timer has to leave the 2182A time for all readings (with autozero),
+        # a trigger that arrives while it is still reading is lost
+        period = self.width*1e-3 + self.burst.burst_time() + num*0.01 + 0.1 # pulse + readings + trigger delay
+        per_segment = max(1024//num,1) # 2182A buffer holds 1024 readings
+
+        self.k2901.write(":SOUR:CURR:MODE LIST")
+        self.k2901.write(":TRIG:SOUR TIM")
+        self.k2901.write(f":TRIG:TIM {period}")
+        self.k2901.write(":SOUR:DIG:EXT1:FUNC TOUT")
+        self.k2901.write(":SOUR:DIG:EXT1:TOUT:POS AFT") # trigger after the pulse
+        self.k2901.write(":TRIG:TRAN:TOUT:SIGN EXT1")
+        self.k2901.write(":TRIG:TRAN:TOUT ON")
+        self.k2182.write(":TRIG:SOUR EXT")
+        self.k2182.write(":TRIG:DEL 0")
+
+        for start in range(self.resume.get('rows',0),len(current_list),per_segment):
+            segment = current_list[start:start+per_segment]
+            print('appiled pulsed current {} to {} mA'.format(segment[0],segment[-1]))
+            self.k2901.write(":SOUR:LIST:CURR {}".format(','.join(str(c*1e-3) for c in segment)))
+            self.k2901.write(f":TRIG:COUN {len(segment)}")
+            self.k2182.write(":TRAC:CLE")
+            self.k2182.write(f":TRAC:POIN {len(segment)*num}")
+            self.k2182.write(":TRAC:FEED SENS")
+            self.k2182.write(":TRAC:FEED:CONT NEXT")
+            self.k2182.write(f":TRIG:COUN {len(segment)}")
+            self.k2182.write(":INIT")
+            self.k2901.write(":INIT")
+            t0 = time.monotonic()
+            self.profiler.sleep(len(segment)*period)
+            while int(self.k2182.query(":TRAC:POIN:ACT?")) < len(segment)*num:
+                if time.monotonic()-t0 > 2*len(segment)*period:
+                    raise TimeoutError('2182A buffer incomplete after {:.0f} s (missed trigger?)'.format(time.monotonic()-t0))
+                self.profiler.sleep(0.1)
+            stats = nanovoltmeter.stats(self.burst.trace().reshape(len(segment),num))
+            self.record(stats,t=t0+period*np.arange(1,len(segment)+1),current=segment,x=stats['mean'])
+
+        # back to single triggered pulses
+        self.k2901.write(":TRIG:TRAN:TOUT OFF")
+        self.k2901.write(":TRIG:SOUR AINT")
+        self.k2901.write(":TRIG:COUN 1")
+        self.k2901.write(":SOUR:CURR:MODE FIX")
+        self.k2182.write(":TRAC:FEED:CONT NEV")
+        self.k2182.write(":TRIG:SOUR IMM")
+        self.k2182.write(":TRIG:COUN 1")
+        self.burst.reset()
+
+        self.writer.flush()
+        self.plotter.save(self.path_name+file_name+'.png',dpi=300)
+
+    def record(self,stats,**columns):
+        # keep the new point and hand it on to the writer and the plotter
+        if self.telemetry is not None:
+            columns.update(self.telemetry.place(columns['t']))
+        block = self.store.append(**columns)
+        self.profiler.count(len(block))
+        resistance = block['x']/(self.mear_curr*1e-3)
+        with self.profiler.phase('save'):
+            values = [block['current'],block['x'],resistance]+[stats[k] for k in STATS_KEYS]
+            if self.telemetry is not None:
+                values.extend(block[c] for c in self.telemetry.channels)
+            self.writer.append(*values)
+        if self.checkpoint is not None:
+            self.checkpoint.progress(rows=self.writer.n_written)
+        with self.profiler.phase('plot'):
+            self.plotter.add(block['current'],resistance)
+        if self.publisher is not None:
+            t_start,rows_start,n_points = self.started
+            done = self.writer.n_written
+            eta = (n_points-done)*(time.monotonic()-t_start)/(done-rows_start) if done > rows_start else None
+            self.publisher.data(block)
+            self.publisher.status('acquiring','current',target=float(block['current'][-1]),done=done,total=n_points,eta=eta)
 
 def end_mearsument():
+    from labdrivers.quantumdesign import qdinstrument
     ppms=qdinstrument.QdInstrument('DynaCool','192.168.0.4')
     ppms.setTemperature(300,12)
     ppms.setField(0)
 
 
 if __name__ == "__main__":
+    os.chdir(sys.path[0])
+    from labdrivers.quantumdesign import qdinstrument
     #current_list = [0,20,25,29,33,37,40]+[37,33,29,25,20,0]+[-20,-25,-29,-33,-37,-40]+[-37,-33,-29,-25,-20]+[0,20,25,29,33,37,40]
     path_name = './SRO_LFO_SIO/22nm/0deg_20x60/'
     ppms0 = qdinstrument.QdInstrument('DynaCool','192.168.0.4')
@@ -0,0 +1,283 @@
+import bisect
+import json
+import sys
+import time
+import threading
+import numpy as np
+import scheduler
+
+# Record the instrument traffic of a real run (every call, its arguments,
+# response and duration) to a JSON-lines log, and replay it later against the
+# unmodified measurement classes, with the recorded latency (realtime=True) or
+# as fast as possible.
+#
+#   recorder = replay.Recorder('run.jsonl')
+#   spin_pumping.AHE(...,session=recorder.session())
+#   recorder.close()
+#
+#   replayer = replay.Replayer('run.jsonl',realtime=False)
+#   spin_pumping.AHE(...,session=replayer.session())
+#   print(replayer.report())
+#
+# A log line is [t, device, method, args, result, duration]; t is seconds since
+# the start of the recording, device the VISA address or 'ppms'.
+
+def encode(value):
+    if isinstance(value,np.ndarray):
+        return {'nd':value.tolist(),'dtype':str(value.dtype)}
+    if isinstance(value,tuple):
+        return [encode(v) for v in value]
+    if isinstance(value,np.generic):
+        return value.item()
+    return value
+
+def decode(value):
+    if isinstance(value,dict) and 'nd' in value:
+        return np.array(value['nd'],dtype=value['dtype'])
+    if isinstance(value,dict) and 'error' in value:
+        raise RuntimeError('recorded error: {}'.format(value['error']))
+    if isinstance(value,list):
+        return tuple(value) # PPMS getters return tuples
+    return value
+
+def normalise(args):
+    # the form the arguments take in the log, used to match calls on replay
+    return json.loads(json.dumps(list(args),default=float))
+
+class Recorded():
+    # transparent proxy that logs every method call of the wrapped object
+    def __init__(self,target,name,recorder):
+        object.__setattr__(self,'_target',target)
+        object.__setattr__(self,'_name',name)
+        object.__setattr__(self,'_recorder',recorder)
+
+    def __getattr__(self,attr):
+        value = getattr(self._target,attr)
+        if not callable(value):
+            return value
+        def call(*args,**kwargs):
+            t = time.perf_counter()
+            try:
+                result = value(*args,**kwargs)
+            except Exception as e:
+                self._recorder.add(t,self._name,attr,args,{'error':'{}: {}'.format(type(e).__name__,e)})
+                raise
+            self._recorder.add(t,self._name,attr,args,encode(result))
+            return result
+        return call
+
+    def __setattr__(self,attr,value):
+        setattr(self._target,attr,value)
+
+class RecordingSession(scheduler.Session):
+    # a Session whose PPMS and VISA resources are recorded
+    def __init__(self,recorder,ppms=None,rm=None,ppms_address=scheduler.PPMS_ADDRESS):
+        super().__init__(ppms,rm,ppms_address)
+        self.recorder = recorder
+        self._recorded_ppms = None
+
+    @property
+    def ppms(self):
+        if self._recorded_ppms is None:
+            self._recorded_ppms = self.recorder.wrap(scheduler.Session.ppms.fget(self),'ppms')
+        return self._recorded_ppms
+
+    def open_resource(self,address):
+        resource = super().open_resource(address)
+        if not isinstance(resource,Recorded):
+            resource = self.resources[address] = self.recorder.wrap(resource,address)
+        return resource
+
+class Recorder():
+    def __init__(self,path):
+        self.file = open(path,'w')
+        self.lock = threading.Lock()
+        self.t_start = time.perf_counter()
+        self.file.write(json.dumps({'version':1,'start':time.time()})+'\n')
+
+    def wrap(self,target,name):
+        return Recorded(target,name,self)
+
+    def session(self,ppms=None,rm=None,ppms_address=scheduler.PPMS_ADDRESS):
+        return RecordingSession(self,ppms,rm,ppms_address)
+
+    def add(self,t,device,method,args,result):
+        duration = time.perf_counter()-t
+        line = json.dumps([round(t-self.t_start,6),device,method,list(args),result,round(duration,6)],
+                          default=float,separators=(',',':'))
+        with self.lock:
+            self.file.write(line+'\n')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def load(path):
+    with open(path) as f:
+        header = json.loads(f.readline())
+        return header,[json.loads(line) for line in f if line.strip()]
+
+class Replayed():
+    # stands in for a recorded instrument; every call returns the next recorded
+    # response of this device to the same method and arguments
+    def __init__(self,name,replayer):
+        object.__setattr__(self,'_name',name)
+        object.__setattr__(self,'_replayer',replayer)
+        # attributes such as timeout are not in the log; they keep what was set
+        object.__setattr__(self,'_attributes',{'timeout':2000})
+
+    @property
+    def resource_name(self):
+        return self._name
+
+    def __getattr__(self,attr):
+        if attr in self._attributes:
+            return self._attributes[attr]
+        def call(*args,**kwargs):
+            return self._replayer.call(self._name,attr,args)
+        return call
+
+    def __setattr__(self,attr,value):
+        self._attributes[attr] = value
+
+class ReplayResourceManager():
+    def __init__(self,replayer):
+        self.replayer = replayer
+
+    def open_resource(self,address):
+        return Replayed(address,self.replayer)
+
+def is_query(method):
+    # queries read state; everything else (write, setField, close, ...) changes it
+    return method.startswith(('query','read','get'))
+
+class Replayer():
+    def __init__(self,path,realtime=True,max_repeats=1000):
+        self.header,entries = load(path)
+        self.realtime = realtime # sleep for the recorded duration of each call
+        self.max_repeats = max_repeats
+        self.lock = threading.Lock()
+        # Per device the log is cut into epochs at every command (write, setField,
+        # ...). Commands are matched in order; a query is answered by the next
+        # recorded response to the same call within the current epoch, so extra or
+        # missing polls (pollers and readers run on their own timing) neither eat
+        # into nor stall the rest of the run. A query the epoch has run out of
+        # repeats its last response, taking its recorded time even when not
+        # realtime, and at most max_repeats times in a row.
+        self.entries = {} # device -> entries in order
+        self.indices = {} # (device, method, args) -> entry indices
+        self.traces = {} # (device, channel) -> SR830 buffer contents seen in the log
+        self.buffer_latency = {} # device -> duration of a recorded buffer read
+        for entry in entries:
+            device_entries = self.entries.setdefault(entry[1],[])
+            self.indices.setdefault(self.key(entry[1],entry[2],entry[3]),[]).append(len(device_entries))
+            device_entries.append(entry)
+            if entry[2] == 'query_binary_values' and entry[3][0].startswith('TRCB?'):
+                self.add_trace(entry)
+        self.epoch_end = {} # device -> index after each entry where its epoch ends
+        for device,device_entries in self.entries.items():
+            ends = [len(device_entries)]*len(device_entries)
+            end = len(device_entries)
+            for i in range(len(device_entries)-1,-1,-1):
+                ends[i] = end
+                if not is_query(device_entries[i][2]):
+                    end = i
+            self.epoch_end[device] = ends
+        self.epoch = {} # device -> index of the last replayed command
+        self.next = {} # key -> first index not yet replayed
+        self.last = {} # key -> last replayed entry
+        self.repeats = {} # key -> repeats of the last entry since it was replayed
+        self.replayed = 0
+        self.repeated = 0
+        self.unmatched = 0
+        self.latency = 0.0 # recorded instrument time of the replayed calls
+        self.t_start = time.perf_counter()
+
+    def key(self,device,method,args):
+        return device,method,json.dumps(args)
+
+    def session(self):
+        return scheduler.Session(ppms=Replayed('ppms',self),rm=ReplayResourceManager(self))
+
+    def add_trace(self,entry):
+        channel,start,n = map(int,entry[3][0][5:].split(','))
+        data = decode(entry[4])
+        trace = self.traces.get((entry[1],channel),np.full(0,np.nan,dtype=data.dtype))
+        if len(trace) < start+len(data):
+            trace = np.concatenate([trace,np.full(start+len(data)-len(trace),np.nan,dtype=data.dtype)])
+        trace[start:start+len(data)] = data
+        self.traces[(entry[1],channel)] = trace
+        self.buffer_latency[entry[1]] = entry[5]
+
+    def trace_entry(self,device,command):
+        # buffer reads are cut into chunks by timing, so a read the log does not
+        # have is answered from the recorded buffer contents
+        channel,start,n = map(int,command[5:].split(','))
+        data = self.traces[(device,channel)][start:start+n]
+        return [0,device,'query_binary_values',[command],encode(data),self.buffer_latency[device]]
+
+    def next_entry(self,device,method,args):
+        key = self.key(device,method,args)
+        indices = self.indices.get(key,[])
+        epoch = self.epoch.get(device,-1)
+        i = bisect.bisect_right(indices,max(epoch,self.next.get(key,-1)-1))
+        if i < len(indices):
+            index = indices[i]
+            if not is_query(method):
+                self.epoch[device] = index
+            if not is_query(method) or epoch < 0 or index < self.epoch_end[device][epoch]:
+                self.next[key] = index+1
+                self.last[key] = self.entries[device][index]
+                self.repeats[key] = 0
+                return self.last[key]
+        if method == 'query_binary_values' and args[0].startswith('TRCB?') and (device,int(args[0][5:].split(',')[0])) in self.traces:
+            return self.trace_entry(device,args[0])
+        if key in self.last:
+            if self.repeats[key] >= self.max_repeats:
+                raise LookupError('no recorded {}.{}{} left to replay ({} repeats of the last one)'.format(
+                    device,method,tuple(args),self.repeats[key]))
+            self.repeats[key] += 1
+            self.repeated += 1
+            return self.last[key]
+        if not is_query(method):
+            # a command the recorded run did not send
+            self.unmatched += 1
+            return [0,device,method,args,None,0]
+        raise LookupError('no recorded {}.{}{} to replay'.format(device,method,tuple(args)))
+
+    def call(self,device,method,args):
+        args = normalise(args)
+        with self.lock:
+            repeated = self.repeated
+            entry = self.next_entry(device,method,args)
+            repeated = self.repeated > repeated
+            self.replayed += 1
+            self.latency += entry[5]
+        if self.realtime or repeated:
+            # a repeat stands for a poll the recording did not have; answering it
+            # at once would let a polling loop spin through the replay
+            time.sleep(entry[5])
+        return decode(entry[4])
+
+    def report(self):
+        wall = time.perf_counter()-self.t_start
+        left = sum(len(indices)-bisect.bisect_left(indices,self.next.get(key,0)) for key,indices in self.indices.items())
+        return ('replayed {} calls in {:.2f} s ({:.2f} s recorded instrument time), {} repeated, {} unmatched, {} not replayed'
+                .format(self.replayed,wall,self.latency,self.repeated,self.unmatched,left))
+
+def summary(path):
+    # per device: calls and instrument time of a log, against its span
+    header,entries = load(path)
+    span = entries[-1][0]+entries[-1][5] if entries else 0
+    lines = ['{}: {} calls over {:.1f} s'.format(path,len(entries),span)]
+    devices = {}
+    for entry in entries:
+        calls,busy = devices.get(entry[1],(0,0.0))
+        devices[entry[1]] = (calls+1,busy+entry[5])
+    for device,(calls,busy) in sorted(devices.items(),key=lambda kv:-kv[1][1]):
+        lines.append('  {:<20s} {:>7d} calls {:>9.2f} s  {:5.1f} %'.format(device,calls,busy,100*busy/span if span else 0))
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        print(summary(path))
@@ -0,0 +1,76 @@
+import collections
+import numpy as np
+
+# Resonance detection for adaptive field sweeps. The lock-in baseline (median)
+# and noise (MAD) are tracked over recent off-resonance samples; a sample whose
+# X/Y deviates from the baseline by more than `threshold` noise sigmas is on
+# resonance. The sweep stays slow from the first such sample until the field has
+# moved `margin` Oe past the last one, and around +-prior (the resonance field
+# found before, e.g. at the previous temperature) when one is given.
+
+# resonance field (Oe) found last, per (frequency, harm), for resonance='previous'
+RESONANCES = {}
+
+class ResonanceDetector():
+    def __init__(self,threshold=6,margin=50,prior=None,window=100,baseline_points=200,min_baseline=20):
+        self.threshold = threshold
+        self.margin = margin
+        self.prior = prior
+        self.window = window
+        self.min_baseline = min_baseline
+        self.baseline = collections.deque(maxlen=baseline_points) # (x, y) off resonance
+        self.center = None
+        self.sigma = None
+        self.last_active = None # field of the last on-resonance sample
+        self.peaks = [] # per excursion: [field, deviation] of the largest deviation
+        self.in_excursion = False
+
+    def update_baseline(self):
+        xy = np.array(self.baseline)
+        self.center = np.median(xy,axis=0)
+        self.sigma = np.maximum(1.4826*np.median(np.abs(xy-self.center),axis=0),1e-15)
+
+    def deviation(self,x,y):
+        # largest deviation of X or Y from the baseline, in noise sigmas
+        d = np.abs(np.column_stack([x,y])-self.center)/self.sigma
+        return d.max(axis=1)
+
+    def add(self,field,x,y):
+        for f,xi,yi in zip(field,x,y):
+            if self.center is None or len(self.baseline) < self.min_baseline:
+                # start of the sweep, assumed off resonance
+                self.baseline.append((xi,yi))
+                if len(self.baseline) >= self.min_baseline:
+                    self.update_baseline()
+                continue
+            d = self.deviation([xi],[yi])[0]
+            if d > self.threshold:
+                self.last_active = f
+                if not self.in_excursion:
+                    self.peaks.append([f,d])
+                    self.in_excursion = True
+                elif d > self.peaks[-1][1]:
+                    self.peaks[-1] = [f,d]
+            else:
+                if self.in_excursion and np.abs(f-self.last_active) > self.margin:
+                    self.in_excursion = False
+                if not self.in_excursion:
+                    self.baseline.append((xi,yi))
+        if self.center is not None and not self.in_excursion:
+            self.update_baseline()
+
+    def near_prior(self,field,lookahead=0):
+        if self.prior is None:
+            return False
+        return np.abs(np.abs(field)-np.abs(self.prior)) <= self.window+lookahead
+
+    def slow(self,field,lookahead=0):
+        # lookahead: Oe the field moves before a rate change takes effect
+        return self.in_excursion or self.near_prior(field,lookahead)
+
+    def resonance(self):
+        # |field| of the strongest deviation per excursion, averaged over the
+        # excursions (the +H and -H resonances of a sweep)
+        if not self.peaks:
+            return None
+        return float(np.median([np.abs(f) for f,d in self.peaks]))
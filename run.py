@@ -0,0 +1,192 @@
+import os
+import sys
+import ast
+import json
+import argparse
+import numpy as np
+import scheduler
+
+# Command line runner for a series of runs described in a JSON plan:
+#
+#   {"measurement": "rotator",
+#    "common": {"path_name": "./AHE/", "file_name": "s1_", "field0": 550, "scan_rate": 2,
+#               "set_temp": true, "waiting_time": 60, "pos1": 0, "pos2": 360, "headless": true},
+#    "grid": {"temperature0": {"range": [300, 49, -50]}, "harm": [1, 2]},
+#    "scheduler": {"pipelined": true, "checkpoint": "series.json"},
+#    "start": {"temperature0": 300, "field0": 0}}
+#
+# "runs" (a list of parameter dicts) can be given instead of or next to "grid".
+# Any value may be written as {"range": [start, stop, step]}, {"linspace":
+# [start, stop, num]} or {"concat": [...]} of those. The measurement module is
+# only imported when the plan really runs, and the instrument libraries only
+# when an instrument is opened.
+#
+#   python run.py plan.json --dry-run       # check the plan and estimate the runtime
+#   python run.py plan.json --simulate 50   # run against the simulated instruments
+#   python run.py plan.json                 # run
+
+# name -> (module, class)
+MEASUREMENTS = {
+    'spin_pumping': ('spin_pumping','AHE'),
+    'rotator': ('Rotator_PPMS_module_6221','AHE'),
+    'pulse_current': ('pulse_current_PPMS_module','Current_swtiching'),
+}
+
+# default PPMS rates of each measurement: temperature K/min, field Oe/s, position degree/s
+RATES = {
+    'spin_pumping': {'temperature':12,'field':200,'position':5},
+    'rotator': {'temperature':10,'field':200,'position':5},
+    'pulse_current': {'temperature':12,'field':200,'position':5},
+}
+
+def expand(value):
+    # the {"range"|"linspace"|"concat": ...} shorthands, as plain lists
+    if isinstance(value,dict) and len(value) == 1:
+        (kind,args), = value.items()
+        if kind == 'range':
+            return np.arange(*args).tolist()
+        if kind == 'linspace':
+            return np.linspace(*args).tolist()
+        if kind == 'concat':
+            return [v for part in args for v in expand(part)]
+    return value
+
+def load_plan(path):
+    with open(path) as f:
+        plan = json.load(f)
+    common = {k:expand(v) for k,v in plan.get('common',{}).items()}
+    runs = [{k:expand(v) for k,v in run.items()} for run in plan.get('runs',[])]
+    if 'grid' in plan:
+        runs += scheduler.grid(**{k:expand(v) for k,v in plan['grid'].items()})
+    return plan,common,runs or [{}]
+
+def signature(measurement):
+    # (required, optional) parameter names of the measurement class, read from
+    # the source so that checking a plan imports nothing
+    module,name = MEASUREMENTS[measurement]
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),module+'.py')) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node,ast.ClassDef) and node.name == name:
+            for item in node.body:
+                if isinstance(item,ast.FunctionDef) and item.name == '__init__':
+                    names = [a.arg for a in item.args.args[1:]]
+                    n_required = len(names)-len(item.args.defaults)
+                    return names[:n_required],names[n_required:]
+    raise ValueError('{} not found in {}.py'.format(name,module))
+
+def check(plan,common,runs):
+    # list of problems, empty if the plan can run
+    measurement = plan.get('measurement')
+    if measurement not in MEASUREMENTS:
+        return ['unknown measurement {!r} (one of {})'.format(measurement,', '.join(MEASUREMENTS))]
+    required,optional = signature(measurement)
+    known = set(required)|set(optional)
+    problems = []
+    for key in common:
+        if key not in known:
+            problems.append('common: unknown parameter {!r}'.format(key))
+    for i,run in enumerate(runs):
+        params = {**common,**run}
+        for key in run:
+            if key not in known:
+                problems.append('run {}: unknown parameter {!r}'.format(i+1,key))
+        missing = [key for key in required if key not in params]
+        if missing:
+            problems.append('run {}: missing {}'.format(i+1,', '.join(missing)))
+    for key in plan.get('scheduler',{}):
+        if key not in ('axes','reorder','pipelined','checkpoint','retries'):
+            problems.append('scheduler: unknown option {!r}'.format(key))
+    return problems
+
+def estimate(measurement,params,state,settle_time=30):
+    # seconds for one run from the ramp rates, scan rates and fixed waits of the
+    # measurement; state: where temperature, field and position are, updated
+    rates = RATES[measurement]
+    def ramp(axis,target,rate):
+        seconds = np.abs(target-state[axis])/rate if state.get(axis) is not None else 0
+        state[axis] = target
+        return seconds
+    total = 0
+    # like the scheduler, every run settles unless the previous one was at the same temperature
+    if params.get('set_temp') and params.get('temperature0') != state.get('previous'):
+        total += ramp('temperature',params['temperature0'],rates['temperature']/60) + settle_time
+        total += params.get('waiting_time',params.get('wating_time',0))
+    state['previous'] = params.get('temperature0')
+    cycles = params.get('cycles',1) if params.get('zigzag') else 1
+    if measurement == 'spin_pumping':
+        field0 = params['field0']
+        total += ramp('field',field0,rates['field']) + 1
+        total += 2*cycles*np.abs(2*field0)/params['scan_rate'] if params.get('zigzag') else np.abs(2*field0)/params['scan_rate']
+        state['field'] = field0 if params.get('zigzag') else -field0
+    elif measurement == 'rotator':
+        pos1,pos2 = params['pos1'],params['pos2']
+        total += 1 + ramp('position',pos1,rates['position']) + ramp('field',params['field0'],rates['field'])
+        legs = 2*cycles
+        total += legs*np.abs(pos2-pos1)/params['scan_rate'] + 2
+        if not params.get('zigzag'):
+            total += 2 + ramp('position',pos2,np.inf) + ramp('position',pos1,np.inf) # settles before each leg
+        state['position'] = pos1
+    elif measurement == 'pulse_current':
+        total += ramp('field',params['sat_field'],rates['field']) + 2 + ramp('field',params['field0'],rates['field']) + 1
+        total += 3*1.1 # test_current
+        n = len(params['current_list'])
+        burst = params.get('num_readings',10)*2*5/50 # 5 NPLC with autozero
+        if params.get('sequenced'):
+            total += n*(params['width']*1e-3 + burst + params.get('num_readings',10)*0.01 + 0.1)
+        else:
+            total += n*(1.2 + burst)
+    return total
+
+def dry_run(plan,common,runs,settle_time=30):
+    measurement = plan['measurement']
+    options = plan.get('scheduler',{})
+    start = plan.get('start',{})
+    if options.get('reorder',True):
+        runs = scheduler.order_runs(runs,options.get('axes',('temperature0','field0')),start)
+    state = {'temperature':start.get('temperature0'),'field':start.get('field0'),'position':start.get('position')}
+    total = 0
+    for i,run in enumerate(runs):
+        seconds = estimate(measurement,{**common,**run},state,settle_time)
+        total += seconds
+        print('run {}/{}: {}  ~{:.0f} s'.format(i+1,len(runs),', '.join('{}={}'.format(k,v) for k,v in run.items()),seconds))
+    print('{} runs, estimated {:.0f} s ({:.1f} h)'.format(len(runs),total,total/3600))
+    return total
+
+def execute(plan,common,runs,speedup=None):
+    import importlib
+    module,name = MEASUREMENTS[plan['measurement']]
+    measurement = getattr(importlib.import_module(module),name)
+    options = dict(plan.get('scheduler',{}))
+    if 'axes' in options:
+        options['axes'] = tuple(options['axes'])
+    if speedup is not None:
+        import simulated
+        ppms = simulated.SimPPMS(speedup=speedup)
+        session = scheduler.Session(ppms=ppms,rm=simulated.SimResourceManager(ppms))
+    else:
+        session = scheduler.Session()
+    try:
+        scheduler.Scheduler(measurement,runs,common,session,start=plan.get('start'),**options).run()
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='run a measurement plan')
+    parser.add_argument('plan',help='JSON plan file')
+    parser.add_argument('--dry-run',action='store_true',help='check the plan and estimate the runtime only')
+    parser.add_argument('--simulate',type=float,metavar='SPEEDUP',help='use the simulated instruments')
+    parser.add_argument('--settle',type=float,default=30,help='s for the temperature to settle after the ramp (estimate)')
+    args = parser.parse_args()
+
+    plan,common,runs = load_plan(args.plan)
+    problems = check(plan,common,runs)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+    if args.dry_run:
+        dry_run(plan,common,runs,args.settle)
+    else:
+        os.chdir(sys.path[0])
+        execute(plan,common,runs,args.simulate)
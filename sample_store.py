@@ -0,0 +1,87 @@
+import numpy as np
+
+# Array-backed storage for acquired samples. One structured record per sample,
+# holding only the fields the measurement fills (see sample_dtype).
+SAMPLE_DTYPE = np.dtype([('t','f8'),           # time.monotonic() (s)
+                         ('field','f8'),       # Oe
+                         ('position','f8'),    # degree
+                         ('current','f8'),     # mA
+                         ('x','f8'),           # V (lock-in X or dc voltage)
+                         ('y','f8'),           # V
+                         ('sensitivity','f8'), # V, lock-in full scale
+                         ('direction','f8'),   # +1/-1, leg of a zig-zag sweep
+                         ('cycle','f8'),       # cycle of a zig-zag sweep
+                         ('temperature','f8'), # K
+                         ('chamber','f8')])    # PPMS chamber status code
+
+# samples a measurement keeps in memory; everything is on disk via the writer
+MAXLEN = 65536
+
+def sample_dtype(names):
+    # the SAMPLE_DTYPE fields a measurement actually fills, in SAMPLE_DTYPE order
+    return np.dtype([(name,SAMPLE_DTYPE[name]) for name in SAMPLE_DTYPE.names if name in names])
+
+class SampleStore():
+    # Capacity doubles when full (amortized O(1) append). With maxlen set the
+    # oldest half is dropped instead, so memory stays bounded on long sweeps.
+    # view()/new() return views into the storage: no copy, but they are only
+    # valid until the next append that needs to grow or compact.
+    def __init__(self,capacity=4096,maxlen=None,dtype=SAMPLE_DTYPE):
+        self.dtype = np.dtype(dtype)
+        if maxlen is not None:
+            capacity = min(capacity,maxlen)
+        self.data = np.empty(capacity,dtype=self.dtype)
+        self.maxlen = maxlen
+        self.n = 0
+        self.dropped = 0 # samples discarded in ring mode
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self,name):
+        return self.data[name][:self.n]
+
+    @property
+    def total(self):
+        # samples appended since creation, including dropped ones
+        return self.dropped + self.n
+
+    def reserve(self,k):
+        if self.n + k <= len(self.data):
+            return
+        if self.maxlen is not None and self.n + k > self.maxlen:
+            keep = max(min(self.n,self.maxlen//2,self.maxlen-k),0)
+            self.data[:keep] = self.data[self.n-keep:self.n]
+            self.dropped += self.n - keep
+            self.n = keep
+            if self.n + k <= len(self.data):
+                return
+        size = max(2*len(self.data),self.n+k)
+        if self.maxlen is not None:
+            size = min(size,max(self.maxlen,k))
+        data = np.empty(size,dtype=self.dtype)
+        data[:self.n] = self.data[:self.n]
+        self.data = data
+
+    def append(self,**columns):
+        # columns are scalars or equal-length arrays; returns the new rows
+        k = max([np.size(v) for v in columns.values()],default=0)
+        self.reserve(k)
+        block = self.data[self.n:self.n+k]
+        for name in self.dtype.names:
+            block[name] = columns.get(name,np.nan)
+        self.n += k
+        return block
+
+    def view(self):
+        return self.data[:self.n]
+
+    def new(self,total):
+        # rows appended after `total` samples (as returned by .total); lets a
+        # reader pick up where it left off
+        start = max(total-self.dropped,0)
+        return self.data[start:self.n]
+
+    def clear(self):
+        self.dropped += self.n
+        self.n = 0
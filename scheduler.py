@@ -0,0 +1,177 @@
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import checkpoint as run_checkpoint
+
+# Batch runs over temperatures x fields x harmonics x ... with one session per
+# instrument. Runs are reordered so that the expensive axes (temperature, then
+# field) move as little as possible: each axis is swept in one direction and the
+# next axis snakes back and forth inside it, so e.g. both harmonics are measured
+# at one temperature and field before anything moves.
+# With pipelined=True each run's saving/plotting (its finish()) is handed to a
+# background worker, so the next run starts its ramp right away.
+# With checkpoint='series.json' a restarted series skips the runs already done
+# and resumes the interrupted one; retries re-runs a failed run from its last
+# checkpoint before giving up.
+
+PPMS_ADDRESS = ('DynaCool','192.168.0.4')
+
+class Session():
+    # shared VISA resources and PPMS connection for a series of runs; pass it to
+    # the measurement classes as session=...
+    def __init__(self,ppms=None,rm=None,ppms_address=PPMS_ADDRESS):
+        self._ppms = ppms
+        self.rm = rm
+        self.ppms_address = ppms_address
+        self.resources = {}
+        self.configs = {}
+
+    @property
+    def ppms(self):
+        if self._ppms is None:
+            from labdrivers.quantumdesign import qdinstrument
+            print('start to connect DynaCool')
+            self._ppms = qdinstrument.QdInstrument(*self.ppms_address)
+            print('connection established')
+        return self._ppms
+
+    def open_resource(self,address):
+        if address not in self.resources:
+            if self.rm is None:
+                import pyvisa
+                self.rm = pyvisa.ResourceManager()
+            self.resources[address] = self.rm.open_resource(address)
+        return self.resources[address]
+
+    def needs_config(self,address,key):
+        # False if the instrument was already configured with the same settings
+        if self.configs.get(address) == key:
+            return False
+        self.configs[address] = key
+        return True
+
+    def close(self):
+        for resource in self.resources.values():
+            resource.close()
+        self.resources = {}
+        self.configs = {}
+
+def grid(**axes):
+    # grid(temperature0=[300,250],field0=[550,-550],harm=[1,2]) -> list of runs
+    names = list(axes)
+    return [dict(zip(names,values)) for values in itertools.product(*[axes[n] for n in names])]
+
+def order_runs(runs,axes=('temperature0','field0'),start=None):
+    # start: current value of each axis, e.g. {'temperature0':300}
+    start = dict(start or {})
+    ordered = []
+    def visit(group,level):
+        if level == len(axes):
+            ordered.extend(group)
+            return
+        axis = axes[level]
+        values = sorted(set(run[axis] for run in group if axis in run))
+        rest = [run for run in group if axis not in run]
+        if start.get(axis) is not None and values:
+            # begin at the end closest to where the axis is now
+            if np.abs(values[-1]-start[axis]) < np.abs(values[0]-start[axis]):
+                values = values[::-1]
+        for value in values:
+            visit([run for run in group if run.get(axis) == value],level+1)
+            start[axis] = value
+        visit(rest,level+1)
+    visit(list(runs),0)
+    return ordered
+
+def travel(runs,rates,start=None):
+    # estimated ramp time (s) through the runs; rates in axis units per second
+    position = dict(start or {})
+    total = 0
+    for run in runs:
+        for axis,rate in rates.items():
+            if axis in run:
+                if position.get(axis) is not None:
+                    total += np.abs(run[axis]-position[axis])/rate
+                position[axis] = run[axis]
+    return total
+
+class Scheduler():
+    def __init__(self,measurement,runs,common=None,session=None,axes=('temperature0','field0'),
+                 start=None,reorder=True,pipelined=False,checkpoint=None,retries=0):
+        self.measurement = measurement
+        self.common = dict(common or {})
+        self.session = session if session is not None else Session()
+        self.runs = order_runs(runs,axes,start) if reorder else list(runs)
+        self.pipelined = pipelined
+        self.futures = []
+        if isinstance(checkpoint,str):
+            checkpoint = run_checkpoint.Checkpoint(checkpoint)
+        self.checkpoint = checkpoint
+        self.retries = retries
+        self.check_outputs()
+
+    def check_outputs(self):
+        # runs that only differ in a parameter their file name leaves out would
+        # overwrite each other's data
+        if not hasattr(self.measurement,'output_name'):
+            return
+        outputs = {}
+        for run in self.runs:
+            params = {**self.common,**run}
+            path = params.get('path_name','')+self.measurement.output_name(**params)
+            if path in outputs:
+                raise ValueError('runs {} and {} both write {}; give them a different path_name or file_name'.format(
+                    outputs[path],run,path))
+            outputs[path] = run
+
+    def check(self,wait=False):
+        # report failed background jobs
+        for future in list(self.futures):
+            if wait or future.done():
+                self.futures.remove(future)
+                if future.exception() is not None:
+                    print('post-processing failed: {}'.format(future.exception()))
+
+    def run(self):
+        t_start = time.monotonic()
+        previous = None
+        post = ThreadPoolExecutor(max_workers=1) if self.pipelined else None
+        for i,run in enumerate(self.runs):
+            params = {**self.common,**run}
+            if self.checkpoint is not None and self.checkpoint.done(run):
+                print('run {}/{} already done'.format(i+1,len(self.runs)))
+                continue
+            if post is not None:
+                params['defer'] = lambda finish: self.futures.append(post.submit(finish))
+            # no need to settle again at the temperature we are already at
+            if previous is not None and params.get('set_temp') and params.get('temperature0') == previous:
+                params['set_temp'] = False
+            previous = params.get('temperature0')
+            print('run {}/{}: {}'.format(i+1,len(self.runs),
+                  ', '.join('{}={}'.format(k,v) for k,v in run.items())))
+            if self.checkpoint is not None:
+                self.checkpoint.start(run)
+                params['checkpoint'] = self.checkpoint
+            for attempt in range(self.retries+1):
+                # an interrupted run at a temperature already reached does not settle again
+                if (self.checkpoint is not None and params.get('set_temp')
+                        and self.checkpoint.at_temperature(params.get('temperature0'),self.session.ppms)):
+                    params['set_temp'] = False
+                try:
+                    result = self.measurement(**params,session=self.session)
+                    # a sweep ended by an instrument error saves its data and returns
+                    if getattr(result,'error',None) is not None:
+                        raise result.error
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        raise
+                    print('run failed ({}), retrying from the checkpoint'.format(e))
+            if self.checkpoint is not None:
+                self.checkpoint.finish(run)
+            self.check()
+        if post is not None:
+            post.shutdown(wait=True)
+            self.check(wait=True)
+        print('{} runs finished in {:.0f} s'.format(len(self.runs),time.monotonic()-t_start))
@@ -0,0 +1,153 @@
+import time
+import threading
+import numpy as np
+
+# Shared settle logic for PPMS temperature, field and position. Polling is
+# adaptive: slow while far from the target, fast when close or when the
+# estimated arrival is near. A set point counts as settled once the status is
+# in status_ok, the value is within tolerance and its drift rate below
+# max_drift, continuously for `hold` seconds.
+
+TEMPERATURE_STABLE = 1 # 1 stable, 6 tracking
+FIELD_STABLE = 4 # holding (driven)
+POSITION_STABLE = 1
+
+# set to stop every settle loop waiting in another thread (see async_instruments.cancel)
+CANCEL = threading.Event()
+
+class Cancelled(Exception):
+    pass
+
+class Settle():
+    def __init__(self,read,target,tolerance=None,status_ok=None,hold=0,max_drift=None,timeout=None,
+                 min_interval=0.1,max_interval=1.0,print_interval=5.0,label='',report=None):
+        self.read = read # returns (value, status)
+        self.target = target
+        self.tolerance = tolerance
+        self.status_ok = status_ok
+        self.hold = hold
+        self.max_drift = max_drift # per second
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.print_interval = print_interval
+        self.label = label
+        self.report = report # called with (target, value, state, eta) after every reading
+        self.history_t = []
+        self.history_v = []
+        self.value = None
+        self.status = None
+        self.since = None # start of the current in-criteria stretch
+        self.state = 'idle'
+
+    def slope(self,window):
+        t,v = np.array(self.history_t),np.array(self.history_v)
+        mask = t >= t[-1]-window
+        if mask.sum() < 3 or t[mask][-1] == t[mask][0]:
+            return None
+        return np.polyfit(t[mask]-t[-1],v[mask],1)[0]
+
+    def eta(self):
+        # seconds until the target is reached (0 when within tolerance, None if
+        # not approaching), from the rate over the last few readings
+        if self.value is None:
+            return None
+        distance = self.target - self.value
+        if self.tolerance is not None and np.abs(distance) <= self.tolerance:
+            return max(self.hold-(time.monotonic()-self.since),0) if self.since is not None else 0
+        rate = self.slope(10)
+        if rate is None or rate*distance <= 0:
+            return None
+        return distance/rate + self.hold
+
+    def drift(self):
+        return self.slope(max(self.hold,10))
+
+    def in_criteria(self):
+        if self.status_ok is not None and self.status not in self.status_ok:
+            return False
+        if self.tolerance is not None and np.abs(self.value-self.target) > self.tolerance:
+            return False
+        if self.max_drift is not None:
+            drift = self.drift()
+            if drift is None or np.abs(drift) > self.max_drift:
+                return False
+        return True
+
+    def next_interval(self):
+        if self.since is not None:
+            remaining = self.hold - (time.monotonic()-self.since)
+            return min(max(remaining,self.min_interval),self.max_interval)
+        if self.tolerance is not None and np.abs(self.value-self.target) <= 5*self.tolerance:
+            return self.min_interval
+        eta = self.eta()
+        if eta is None:
+            return self.max_interval
+        return min(max(eta/4,self.min_interval),self.max_interval)
+
+    def poll(self):
+        now = time.monotonic()
+        self.value,self.status = self.read()
+        self.history_t.append(now)
+        self.history_v.append(self.value)
+        # keep what the drift and eta estimates need
+        while self.history_t[0] < now - max(self.hold,10) - 5:
+            self.history_t.pop(0)
+            self.history_v.pop(0)
+        if self.in_criteria():
+            if self.since is None:
+                self.since = now
+            self.state = 'holding'
+        else:
+            self.since = None
+            self.state = 'approaching'
+        if self.report is not None:
+            self.report(self.target,self.value,self.state,self.eta())
+        return now
+
+    def settled(self,now):
+        return self.since is not None and now - self.since >= self.hold
+
+    def wait(self):
+        t_start = time.monotonic()
+        last_print = -np.inf
+        while True:
+            now = self.poll()
+            if self.settled(now):
+                self.state = 'settled'
+                if self.report is not None:
+                    self.report(self.target,self.value,self.state,0)
+                return self.value
+            if self.timeout is not None and now - t_start > self.timeout:
+                self.state = 'timeout'
+                raise TimeoutError('{} did not settle at {} within {} s (last {}, status {})'.format(
+                    self.label,self.target,self.timeout,self.value,self.status))
+            if now - last_print >= self.print_interval:
+                eta = self.eta()
+                print(self.value,self.status,'' if eta is None else 'eta {:.0f} s'.format(eta))
+                last_print = now
+            if CANCEL.wait(self.next_interval()):
+                self.state = 'cancelled'
+                raise Cancelled('{} settle at {} cancelled'.format(self.label,self.target))
+
+def set_temperature(ppms,temperature0,t_rate=12,hold=0,tolerance=None,max_drift=None,timeout=None,report=None):
+    print('start to set temperature to {}'.format(temperature0))
+    ppms.setTemperature(temperature0,t_rate)
+    time.sleep(0.5)
+    Settle(lambda: ppms.getTemperature()[1:],temperature0,tolerance,[TEMPERATURE_STABLE],hold,max_drift,timeout,
+           label='temperature',report=report).wait()
+    print('temperature set successfully')
+
+def set_field(ppms,field0,h_rate=200,tolerance=1,hold=0,timeout=None,report=None):
+    print('start to set field to {}'.format(field0))
+    ppms.setField(field0,h_rate)
+    time.sleep(0.5)
+    Settle(lambda: ppms.getField()[1:],field0,tolerance,[FIELD_STABLE],hold,timeout=timeout,label='field',report=report).wait()
+    print('field set successfully')
+
+def set_position(ppms,pos0,p_rate=5,tolerance=0.1,hold=0,timeout=None,report=None):
+    print('start to set position to {}'.format(pos0))
+    ppms.setPosition(pos0,p_rate)
+    time.sleep(0.5)
+    Settle(lambda: ppms.getPosition()[1:],pos0,tolerance,[POSITION_STABLE],hold,timeout=timeout,label='position',report=report).wait()
+    print('position set successfully')
@@ -0,0 +1,352 @@
+import time
+import numpy as np
+import sr830_range
+
+# Simulated instruments for running the measurement classes without hardware:
+# a DynaCool (temperature/field/position ramps with QD status codes), SR830,
+# 6221, B2901A, 2182A and E8257D. Every call can be given a latency. Ramps run
+# `speedup` times faster than the requested rates so long sweeps finish quickly.
+#
+#   ppms = simulated.SimPPMS(speedup=50)
+#   session = scheduler.Session(ppms=ppms,rm=simulated.SimResourceManager(ppms))
+
+# QD status codes used by the scripts
+TEMPERATURE_STABLE,TEMPERATURE_TRACKING = 1,2
+FIELD_HOLDING,FIELD_CHARGING = 4,6
+POSITION_DONE,POSITION_MOVING = 1,5
+CHAMBER_SEALED = 1 # purged and sealed
+
+class Ramp():
+    def __init__(self,value,speedup=1):
+        self.start = value
+        self.target = value
+        self.rate = np.inf
+        self.t0 = time.monotonic()
+        self.speedup = speedup
+
+    def set(self,target,rate):
+        # rate in units per second
+        self.start = self.value()
+        self.target = target
+        self.rate = rate*self.speedup
+        self.t0 = time.monotonic()
+
+    def value(self,t=None):
+        t = time.monotonic() if t is None else t
+        t = np.maximum(t-self.t0,0)
+        distance = self.target-self.start
+        return self.start + np.sign(distance)*np.minimum(np.abs(distance),self.rate*t)
+
+    def arrival(self):
+        return self.t0 + np.abs(self.target-self.start)/self.rate
+
+    def done(self):
+        return time.monotonic() >= self.arrival()
+
+class SimPPMS():
+    # same calls and return values as labdrivers' QdInstrument
+    def __init__(self,temperature=300,field=0,position=0,speedup=1,latency=0.0,settle_time=10):
+        self.temperature = Ramp(temperature,speedup)
+        self.field = Ramp(field,speedup)
+        self.position = Ramp(position,speedup)
+        self.speedup = speedup
+        self.latency = latency
+        self.settle_time = settle_time # s at the target before the temperature is 'stable'
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def setTemperature(self,temperature,rate=10):
+        self.wait()
+        self.temperature.set(temperature,rate/60) # K/min
+
+    def getTemperature(self):
+        self.wait()
+        stable = time.monotonic() >= self.temperature.arrival() + self.settle_time/self.speedup
+        return 0,float(self.temperature.value()),TEMPERATURE_STABLE if stable else TEMPERATURE_TRACKING
+
+    def setField(self,field,rate=200):
+        self.wait()
+        self.field.set(field,rate)
+
+    def getField(self):
+        self.wait()
+        return 0,float(self.field.value()),FIELD_HOLDING if self.field.done() else FIELD_CHARGING
+
+    def setPosition(self,position,rate=5):
+        self.wait()
+        self.position.set(position,rate)
+
+    def getPosition(self):
+        self.wait()
+        return 0,float(self.position.value()),POSITION_DONE if self.position.done() else POSITION_MOVING
+
+    def getChamber(self):
+        self.wait()
+        return 0,CHAMBER_SEALED
+
+def fmr_signal(field,position,harm,h_res=450,linewidth=30,symmetric=2e-6,antisymmetric=0.5e-6):
+    # ISHE voltage: symmetric + antisymmetric Lorentzian at +-h_res, odd in field
+    d = np.abs(field)-h_res
+    lorentz = linewidth**2/(d**2+linewidth**2)
+    x = np.sign(field)*(symmetric*lorentz + antisymmetric*lorentz*d/linewidth)
+    return x,0.05*x
+
+def angle_signal(field,position,harm,first=1e-4,second=2e-6):
+    # planar Hall sin(2 theta) at 1w, SOT-like cos(theta) + cos(3 theta) at 2w
+    theta = np.radians(position)
+    if harm == 2:
+        x = np.sign(field)*second*(np.cos(theta)+0.3*np.cos(3*theta))
+    else:
+        x = first*np.sin(2*theta)
+    return x,0.02*x
+
+class SimInstrument():
+    def __init__(self,address,latency=0.0,seed=0):
+        self.resource_name = address
+        self.latency = latency
+        self.timeout = 2000
+        self.settings = {}
+        self.rng = np.random.default_rng(seed)
+        self.log = []
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def parse(self,command):
+        parts = command.strip().split(None,1)
+        return parts[0].upper(),(parts[1] if len(parts) > 1 else '')
+
+    def write(self,command):
+        self.wait()
+        self.log.append(command)
+        head,args = self.parse(command)
+        self.settings[head] = args
+        self.command(head,args)
+
+    def command(self,head,args):
+        pass
+
+    def query(self,command):
+        self.wait()
+        head,args = self.parse(command)
+        return self.answer(head,args)
+
+    def answer(self,head,args):
+        return self.settings.get(head.rstrip('?'),'0')
+
+    def query_binary_values(self,command,**kwargs):
+        self.wait()
+        head,args = self.parse(command)
+        return np.asarray(self.binary(head,args),dtype=np.float32).astype(float)
+
+    def binary(self,head,args):
+        return np.empty(0)
+
+    def close(self):
+        pass
+
+class SimSR830(SimInstrument):
+    def __init__(self,address,ppms,signal=fmr_signal,noise=5e-8,latency=0.0,seed=0):
+        super().__init__(address,latency,seed)
+        self.ppms = ppms
+        self.signal = signal
+        self.noise = noise
+        self.buffer_t0 = None
+        self.buffer_stop = None
+        self.settings.update({'HARM':'1','SENS':'17','OFLT':'8','OFSL':'1','SRAT':'10'})
+        self.status = 0 # latched LIAS? bits
+
+    def xy(self,t):
+        harm = int(self.settings.get('HARM','1'))
+        x,y = self.signal(self.ppms.field.value(t),self.ppms.position.value(t),harm)
+        n = np.shape(t)
+        x,y = x+self.noise*self.rng.standard_normal(n),y+self.noise*self.rng.standard_normal(n)
+        # the outputs saturate a little above full scale and latch the overload bit
+        limit = 1.09*sr830_range.SENSITIVITIES[int(self.settings['SENS'])]
+        if np.any(np.abs(x) > limit) or np.any(np.abs(y) > limit):
+            self.status |= 0b100
+        return np.clip(x,-limit,limit),np.clip(y,-limit,limit)
+
+    def rate(self):
+        return 2.0**(int(self.settings['SRAT'])-4)
+
+    def points(self):
+        if self.buffer_t0 is None:
+            return 0
+        end = self.buffer_stop if self.buffer_stop is not None else time.monotonic()
+        return int(min((end-self.buffer_t0)*self.rate()+1,16383))
+
+    def command(self,head,args):
+        if head == 'REST':
+            self.buffer_t0 = None
+            self.buffer_stop = None
+        elif head == 'STRT':
+            self.buffer_t0 = time.monotonic()
+            self.buffer_stop = None
+        elif head == 'PAUS':
+            self.buffer_stop = time.monotonic()
+
+    def answer(self,head,args):
+        if head.startswith('SNAP?'):
+            x,y = self.xy(time.monotonic())
+            return '{:.6e},{:.6e}\n'.format(float(x),float(y))
+        if head == 'SPTS?':
+            return '{}\n'.format(self.points())
+        if head == 'LIAS?':
+            status,self.status = self.status,0
+            return '{}\n'.format(status)
+        return super().answer(head,args)
+
+    def binary(self,head,args):
+        if head == 'TRCB?':
+            channel,start,n = map(int,args.split(','))
+            t = self.buffer_t0 + (start+np.arange(n))/self.rate()
+            return self.xy(t)[channel-1]
+        return super().binary(head,args)
+
+class SimDigitizer():
+    # raw sample voltage under the 6221 AC current and the current itself, as a
+    # two channel buffered digitizer would record them: harmonic n carries
+    # angle_signal(harm=n) (3w: a tenth of 2w) at the reference phase phases[n-1]
+    # of the lock-in. The 6221 runs off its own clock: phase (degree, random if
+    # None) at t = 0 and a frequency off by clock_error.
+    def __init__(self,ppms,frequency=1713,rate=20000,noise=1e-6,latency=0.0,seed=0,
+                 current=5e-3,phase=None,clock_error=5e-6,phases=(0,90,0)):
+        self.ppms = ppms
+        self.frequency = frequency
+        self.current = current
+        self.clock_error = clock_error
+        self.phases = np.radians(phases)
+        self.rate = rate
+        self.noise = noise
+        self.latency = latency
+        self.rng = np.random.default_rng(seed)
+        self.phase = np.radians(phase) if phase is not None else self.rng.uniform(0,2*np.pi)
+        self.t0 = None
+        self.count = 0
+
+    def start(self):
+        self.t0 = time.monotonic()
+        self.count = 0
+
+    def fetch(self):
+        if self.latency:
+            time.sleep(self.latency)
+        n = int((time.monotonic()-self.t0)*self.rate)-self.count
+        t = self.t0+(self.count+np.arange(n))/self.rate
+        self.count += n
+        field,position = self.ppms.field.value(t),self.ppms.position.value(t)
+        v = self.noise*self.rng.standard_normal(n)
+        source = 2*np.pi*self.frequency*(1+self.clock_error)*t + self.phase
+        for harm,scale in ((1,1),(2,1),(3,0.1)):
+            x,y = angle_signal(field,position,min(harm,2))
+            arg = harm*source + self.phases[harm-1]
+            v += np.sqrt(2)*scale*(x*np.cos(arg)-y*np.sin(arg))
+        return t,v,self.current*np.cos(source)
+
+class SimSwitchingSample():
+    # current induced switching: the state flips when a pulse exceeds the
+    # critical current with the opposite sign
+    def __init__(self,resistance=100.0,delta=0.5,critical=6e-3,noise=2e-7,seed=0):
+        self.resistance = resistance
+        self.delta = delta
+        self.critical = critical
+        self.noise = noise
+        self.state = 1
+        self.rng = np.random.default_rng(seed)
+
+    def pulse(self,current):
+        if current >= self.critical:
+            self.state = 1
+        elif current <= -self.critical:
+            self.state = -1
+
+    def voltage(self,current,n):
+        return current*(self.resistance+self.delta*self.state) + self.noise*self.rng.standard_normal(n)
+
+class Sim2182(SimInstrument):
+    def __init__(self,address,sample,latency=0.0,seed=0):
+        super().__init__(address,latency,seed)
+        self.sample = sample
+        self.source_current = 0.0
+        self.buffer = []
+        self.armed = False
+
+    def count(self):
+        return int(float(self.settings.get(':SAMP:COUN','1')))
+
+    def command(self,head,args):
+        if head in ('*RST',':TRAC:CLE'):
+            self.buffer = []
+        elif head == ':INIT':
+            self.armed = self.settings.get(':TRIG:SOUR','IMM').upper().startswith('EXT')
+
+    def trigger(self):
+        # trigger link input
+        if self.armed:
+            self.buffer.extend(self.sample.voltage(self.source_current,self.count()))
+
+    def readings(self,head):
+        if head == ':READ?':
+            return self.sample.voltage(self.source_current,self.count())
+        if head == ':TRAC:DATA?':
+            return np.array(self.buffer)
+        return None
+
+    def answer(self,head,args):
+        readings = self.readings(head)
+        if readings is not None:
+            return ','.join('{:+.9E}'.format(v) for v in readings)+'\n'
+        if head == ':TRAC:POIN:ACT?':
+            return '{}\n'.format(len(self.buffer))
+        return super().answer(head,args)
+
+    def binary(self,head,args):
+        readings = self.readings(head)
+        return readings if readings is not None else super().binary(head,args)
+
+class Sim2901(SimInstrument):
+    def __init__(self,address,sample,nanovoltmeter,latency=0.0,seed=0):
+        super().__init__(address,latency,seed)
+        self.sample = sample
+        self.nanovoltmeter = nanovoltmeter
+
+    def command(self,head,args):
+        if head == ':SOUR:CURR':
+            self.nanovoltmeter.source_current = float(args)
+        elif head == ':INIT':
+            if self.settings.get(':SOUR:CURR:MODE','FIX').upper().startswith('LIST'):
+                pulses = [float(v) for v in self.settings[':SOUR:LIST:CURR'].split(',')]
+            else:
+                pulses = [float(self.settings.get(':SOUR:CURR:TRIG','0'))]
+            for current in pulses:
+                self.sample.pulse(current)
+                self.nanovoltmeter.trigger()
+
+# address -> instrument as used by the three measurement scripts
+SR830_SIGNALS = {'GPIB1::8::INSTR':fmr_signal,'GPIB0::8::INSTR':angle_signal}
+
+class SimResourceManager():
+    def __init__(self,ppms,latency=0.0,seed=0):
+        self.ppms = ppms
+        self.latency = latency
+        self.seed = seed
+        self.sample = SimSwitchingSample(seed=seed)
+        self.instruments = {}
+
+    def make(self,address):
+        if address in SR830_SIGNALS:
+            return SimSR830(address,self.ppms,SR830_SIGNALS[address],latency=self.latency,seed=self.seed)
+        if address == 'GPIB0::7::INSTR':
+            return Sim2182(address,self.sample,self.latency,self.seed)
+        if address == 'GPIB1::17::INSTR':
+            return Sim2901(address,self.sample,self.open_resource('GPIB0::7::INSTR'),self.latency,self.seed)
+        return SimInstrument(address,self.latency,self.seed) # 6221, E8257D
+
+    def open_resource(self,address):
+        if address not in self.instruments:
+            self.instruments[address] = self.make(address)
+        return self.instruments[address]
@@ -1,159 +1,252 @@
-import pyvisa
 import time
-import pandas as pd
-import matplotlib.pyplot as plt
+import contextlib
 import os,sys
 import numpy as np
-from labdrivers.quantumdesign import qdinstrument
-from matplotlib.animation import FuncAnimation
+import sr830_range
+import acquisition
+import live_plot
+import data_writer
+import sample_store
+import settle
+import async_instruments
+import profiling
+import resonance
+import lorentzian
+import catalog as run_catalog
+import zigzag as zigzag_sweep
+import publisher
+import telemetry as telemetry_sampler
 #from MultiPyVu import MultiVuClient as mvc
 
-os.chdir(sys.path[0])
-
 class AHE():
-    def __init__(self,path_name,file_name,frequency,temperature0,field0,scan_rate,harm,set_temp,waiting_time,ppms):
+    def __init__(self,path_name,file_name,frequency,temperature0,field0,scan_rate,harm,set_temp,waiting_time,ppms=None,buffered=False,threaded=False,sample_rate=64,headless=False,session=None,defer=None,adaptive=False,fast_rate=None,prior=None,fit=False,early_stop=None,catalog=True,checkpoint=None,autorange=False,zigzag=False,cycles=1,publish=None,telemetry=None):
+        # run parameters for the catalog
+        self.params = {k:v for k,v in locals().items() if k not in ('self','ppms','session','defer','catalog','checkpoint','publish')}
         self.path_name = path_name
+        # times every instrument call and wait of this run
+        self.profiler = profiling.Profiler()
         # ---------------------------------------------------------
         # ---------------------------------------------------------
-        self.file_name = file_name+'temperature_{}K_field_{}Oe_{}GHz_SP'.format(temperature0,field0,frequency)
+        self.file_name = self.output_name(file_name,temperature0,field0,frequency,harm)
         self.frequency = frequency
-        # Initialize the VISA resource manager
-        rm = pyvisa.ResourceManager()
+        # runs are registered in <path_name>/catalog.sqlite unless catalog=False
+        self.catalog = run_catalog.open_catalog(catalog,path_name)
+        # samples and run status go to a local stream for live viewers (see publisher.py)
+        self.publisher = publisher.open_publisher(publish)
+        if self.publisher is not None:
+            self.publisher.run = self.file_name
+        # Initialize the VISA resource manager (or reuse the open ones of a session)
+        self.session = session
+        if session is not None:
+            rm = session
+        else:
+            import pyvisa
+            rm = pyvisa.ResourceManager()
         # Open connections
         #self.k2901 = rm.open_resource('GPIB0::17::INSTR') #B2901A
-        self.sr830 = rm.open_resource('GPIB1::8::INSTR')  #sr830
-        self.e8257d = rm.open_resource('GPIB0::19::INSTR')
+        self.sr830 = self.profiler.wrap(rm.open_resource('GPIB1::8::INSTR'),'sr830')  #sr830
+        self.e8257d = self.profiler.wrap(rm.open_resource('GPIB0::19::INSTR'),'e8257d')
         #self.k2901 = rm.open_resource('GPIB1::17::INSTR') #B2901A
         #self.volt = volt
         self.harm = harm
-        self.set_config()
 
         print('start to connect DynaCool')
-        self.ppms=ppms
+        if ppms is None and session is not None:
+            ppms = session.ppms
+        elif ppms is None:
+            from labdrivers.quantumdesign import qdinstrument
+            ppms = qdinstrument.QdInstrument('DynaCool','192.168.0.4')
+        self.ppms=self.profiler.wrap(ppms,'ppms')
         print('connection established')
 
+        # configure the instruments while the temperature settles
+        jobs = []
+        if session is None or session.needs_config('spin_pumping',(harm,frequency,autorange)):
+            jobs.append(async_instruments.configure(self.config_commands()))
         if set_temp:
-            self.set_temp(temperature0)
-            for i in range(waiting_time):
-                print("waiting temperature {} second left".format(waiting_time-i))
-                time.sleep(1)
-        self.set_field(field0)
+            jobs.append(async_instruments.on_ppms(self.set_temp,temperature0,hold=waiting_time))
+        async_instruments.run(*jobs)
+        # an interrupted run (see checkpoint.py) continues from the last saved field
+        self.checkpoint = checkpoint
+        self.resume = checkpoint.resume() if checkpoint is not None else {}
+        if checkpoint is not None and set_temp:
+            checkpoint.settled(temperature0)
+        self.set_field(self.resume.get('field',field0))
+
+        # with autorange the SR830 sensitivity follows the signal (see sr830_range.py),
+        # samples are taken at the rate the time constant resolves and each one is
+        # saved with its full scale
+        self.autorange = sr830_range.AutoRange(self.sr830) if autorange else None
+        if self.autorange is not None:
+            sample_rate = min(sample_rate,self.autorange.sample_rate())
+
+        # with zigzag the field runs field0 -> -field0 -> field0 for `cycles` cycles
+        # in one continuous acquisition, every point tagged with direction and cycle;
+        # without, the sweep is the single leg field0 -> -field0
+        legs = zigzag_sweep.legs(field0,-field0,cycles) if zigzag else [(field0,-field0)]
+        self.leg = self.resume.get('leg',0)
+        if 'field' in self.resume:
+            legs[self.leg] = (self.resume['field'],legs[self.leg][1])
+        self.sweep = zigzag_sweep.SweepLog(self.leg) if zigzag else None
 
-        self.fields = []
-        self.voltages = []
-        self.voltages_y = []
+        # with telemetry temperature, position and chamber status are read in the
+        # background (every telemetry s) and saved with every point
+        self.telemetry = telemetry_sampler.open_telemetry(telemetry,self.ppms,axes=('field',))
+
+        # Points are streamed to disk as they are acquired
+        self.store = sample_store.SampleStore(maxlen=sample_store.MAXLEN,dtype=sample_store.sample_dtype(
+            ['t','field','x','y']+(['sensitivity'] if autorange else [])+(['direction','cycle'] if zigzag else [])
+            +(self.telemetry.channels if self.telemetry is not None else [])))
+        self.writer = data_writer.StreamWriter(self.path_name + self.file_name,['field (Oe)','voltage_x (V)','voltage_y (V)']
+                                               + (['sensitivity (V)'] if autorange else [])
+                                               + (['direction','cycle'] if zigzag else [])
+                                               + ([telemetry_sampler.COLUMNS[c] for c in self.telemetry.channels]
+                                                  if self.telemetry is not None else []),
+                                               resume_rows=self.resume.get('rows'))
 
         # Prepare for plotting
-        self.animating = True
-        self.fig = plt.figure(figsize=(10,4))
-        self.ax1 = self.fig.add_axes([0.15,0.2,0.3,0.7])
-        self.ax2 = self.fig.add_axes([0.65,0.2,0.3,0.7])
-        plt.subplots_adjust(left=0.2,right=0.9,top=0.9,bottom=0.2)
-        self.ax1.set_xlabel("Field (Oe)")
-        self.ax1.set_ylabel("Voltage_x (V)")
-        self.ax2.set_xlabel("Field (Oe)")
-        self.ax2.set_ylabel("Voltage_y (V)")
+        self.plotter = live_plot.make_plotter(headless,"Field (Oe)",["Voltage_x (V)","Voltage_y (V)"],
+                                              [[0.15,0.2,0.3,0.7],[0.65,0.2,0.3,0.7]],figsize=(10,4))
 
         #self.k2901.write(":OUTP ON")  # Turn on the output
         self.e8257d.write('OUTP ON')
         self.sr830.write("SLVL 1")
-        time.sleep(0.5)
-        self.scan_field(-field0,scan_rate)
-        time.sleep(0.5)
+        # online Lorentzian fit of both resonances; with early_stop (relative
+        # uncertainty, e.g. 0.02) the sweep ends once both are fitted that well
+        self.fitter = lorentzian.SweepFitter() if fit or early_stop else None
+        self.early_stop = early_stop
+        self.profiler.sleep(0.5)
+        self.error = None # instrument error that ended the sweep early
+        with self.profiler.phase('acquire'),self.telemetry or contextlib.nullcontext():
+            if adaptive and not zigzag:
+                # ramp at fast_rate through flat regions, at scan_rate around the
+                # resonance; prior: resonance field in Oe, or 'previous' for the one
+                # found in the last sweep at this frequency
+                if prior == 'previous':
+                    prior = resonance.RESONANCES.get((frequency,harm))
+                detector = resonance.ResonanceDetector(prior=prior)
+                self.scan_field_pipelined(legs,self.leg,scan_rate,buffered,sample_rate,detector,fast_rate or 5*scan_rate)
+                self.resonance = detector.resonance()
+                if self.resonance is not None:
+                    resonance.RESONANCES[(frequency,harm)] = self.resonance
+                print('resonance at +-{} Oe'.format(self.resonance))
+            elif buffered or threaded or zigzag:
+                # with zigzag always: the legs are one continuous acquisition
+                self.scan_field_pipelined(legs,self.leg,scan_rate,buffered,sample_rate)
+            else:
+                self.scan_field(-field0,scan_rate,sample_rate)
+        if self.fitter is not None:
+            print(self.fitter.text())
+            if self.fitter.resonance() is not None:
+                resonance.RESONANCES[(frequency,harm)] = self.fitter.resonance()
+        self.profiler.sleep(0.5)
         #self.k2901.write(":OUTP OFF")  # Turn on the output
         self.sr830.write("SLVL 0.01")
         self.e8257d.write('OUTP OFF')
 
-        print('measurement compeleted')
-        self.animating = False 
-        plt.ioff()
-        plt.close()
-        plt.clf()
+        if self.error is not None:
+            # the data taken so far is saved, not catalogued; a scheduler retries or
+            # resumes the run and the completed attempt registers it once
+            print('measurement incomplete: {}'.format(self.error))
+            self.finish()
+        else:
+            print('measurement compeleted')
+            if defer is not None:
+                defer(self.finish)
+            else:
+                self.finish()
 
-        # Close the connections
-        self.sr830.close()
+        # Close the connections (a session keeps them open for the next run)
+        if session is None:
+            self.sr830.close()
 
-    def set_config(self):
+    @staticmethod
+    def output_name(file_name,temperature0,field0,frequency,harm,**params):
+        # data file name without extension; the scheduler checks that runs differ in it
+        return file_name+'temperature_{}K_field_{}Oe_{}GHz_{}harm_SP'.format(temperature0,field0,frequency,harm)
+
+    def finish(self):
+        # Saving and closing the plot. A pipelined scheduler runs this in the
+        # background while the next run already ramps temperature/field.
+        with self.profiler.phase('save'):
+            self.writer.close()
+            if self.fitter is not None:
+                self.fitter.save(self.path_name + self.file_name)
+            if self.catalog is not None and self.error is None:
+                run_catalog.register(self.catalog,'spin_pumping',self,self.config_commands(),
+                                     self.fitter.results() if self.fitter is not None else None)
+        with self.profiler.phase('plot'):
+            self.plotter.close()
+        self.profiler.save(self.path_name + self.file_name)
+
+    def config_commands(self):
+        sr830 = []
+        e8257d = []
         # Configure Keysight B2901A for pulsed current output
         # Configure Keithley 2182A to measure voltage
-        self.sr830.write('*RST')
-        self.sr830.write("FREQ 1713")
-        self.sr830.write("SLVL 0.01")
+        sr830.append('*RST')
+        sr830.append("FREQ 1713")
+        sr830.append("SLVL 0.01")
         if self.harm == 2:
-            self.sr830.write("PHAS 90")
+            sr830.append("PHAS 90")
         elif self.harm ==1:
-            self.sr830.write("PHAS 0")
-        self.sr830.write("HARM {}".format(self.harm))
-        self.sr830.write("ISRC 1")
+            sr830.append("PHAS 0")
+        sr830.append("HARM {}".format(self.harm))
+        sr830.append("ISRC 1")
         if self.harm == 2:
-            self.sr830.write("SENS 11")
+            sr830.append("SENS 11")
         elif self.harm == 1:
-            #self.sr830.write("SENS 16") #500uV
-            self.sr830.write("SENS 17") #11-10uV  10-5uV
-            #self.sr830.write("SENS 24") #200mV
-        # self.sr830.write("OFIT 8")  # unknown probably mistyped
-        self.sr830.write("OFLT 8")  # time constant
-        self.sr830.write("OFSL 8")  # slope
-        self.sr830.write('FMOD 1')  # internal
-        self.sr830.write('RSLP 0')  # sine
-        self.sr830.write("RMOD 2")  # low noise
-        self.sr830.write("OEXP 1,0,2") # x,offset,expand
-        self.sr830.write("OEXP 2,0,2") # x,offset,expand
+            #sr830.append("SENS 16") #500uV
+            sr830.append("SENS 17") #11-10uV  10-5uV
+            #sr830.append("SENS 24") #200mV
+        # sr830.append("OFIT 8")  # unknown probably mistyped
+        sr830.append("OFLT 8")  # time constant
+        sr830.append("OFSL 8")  # slope
+        sr830.append('FMOD 1')  # internal
+        sr830.append('RSLP 0')  # sine
+        sr830.append("RMOD 2")  # low noise
+        sr830.append("OEXP 1,0,2") # x,offset,expand
+        sr830.append("OEXP 2,0,2") # x,offset,expand
 
         # Set frequency to 4 GHz
-        self.e8257d.write('FREQ {} GHz'.format(self.frequency))
+        e8257d.append('FREQ {} GHz'.format(self.frequency))
         # Set power to 20 dBm
-        self.e8257d.write('POW 20 dBm')
+        e8257d.append('POW 20 dBm')
         # Enable AM modulation
-        self.e8257d.write('AM:STATE ON')
+        e8257d.append('AM:STATE ON')
         # Select the AM modulation source as External1
-        self.e8257d.write('AM:SOUR EXT1')
+        e8257d.append('AM:SOUR EXT1')
         # Set AM type to Linear
-        self.e8257d.write('AM:TYPE LIN')
+        e8257d.append('AM:TYPE LIN')
         # Set AM depth to 100%
-        self.e8257d.write('AM:DEPT 100')
-
-    def set_temp(self,temperature0,t_rate=12):
-        print('start to set temperature to {}'.format(temperature0))
-        self.ppms.setTemperature(temperature0,t_rate)
-        time.sleep(0.5)
-        _, temperature, status = self.ppms.getTemperature()
-        while status != 1: #1 stable 6 Tracking
-            _, temperature, status = self.ppms.getTemperature()
-            print(temperature,status)
-            time.sleep(1)
-            pass
-        print('temperature set successfully')
+        e8257d.append('AM:DEPT 100')
+
+        return [(self.sr830,sr830),(self.e8257d,e8257d)]
+
+    def set_config(self):
+        # the instruments sit on different GPIB boards and are configured concurrently
+        async_instruments.run(async_instruments.configure(self.config_commands()))
+
+    def set_temp(self,temperature0,t_rate=12,hold=0):
+        # hold: seconds the temperature must stay stable before returning
+        with self.profiler.phase('settle'):
+            settle.set_temperature(self.ppms,temperature0,t_rate,hold=hold,report=self.reporter('temperature'))
+
+    def reporter(self,quantity):
+        # settle progress for the live stream
+        return self.publisher.settle_reporter(quantity) if self.publisher is not None else None
 
     def set_field(self,field0,h_rate=200):
-        print('start to set field to {}'.format(field0))
-        self.ppms.setField(field0,h_rate)
-        time.sleep(0.5)
-        _,field, status = self.ppms.getField()
-        while status != 4 or np.abs(field-field0)>1: 
-            _,field, status = self.ppms.getField()
-            print(field,status)
-            time.sleep(1)
-            pass
-        print('field set successfully')
-
-
-    def scan_field(self,end_field,scan_rate):
-        print('start to scan field')
-        time.sleep(0.1)
-        def animate(i):
-            if not self.animating:
-                ani.event_source.stop()  # Stop the animation
-                return
-            self.ax1.clear()
-            self.ax1.plot(self.fields, self.voltages, '-o', color='#1f77b4')
-            self.ax2.clear()
-            self.ax2.plot(self.fields, self.voltages_y, '-o', color='#1f77b4')
-        # Start the animation
-        ani = FuncAnimation(self.fig, animate, interval=3000, cache_frame_data=False)  # Update every 2000 ms
+        with self.profiler.phase('settle'):
+            settle.set_field(self.ppms,field0,h_rate,report=self.reporter('field'))
 
+
+    def scan_field(self,end_field,scan_rate,sample_rate=None):
+        print('start to scan field')
+        self.target = (end_field,scan_rate,0)
+        self.profiler.sleep(0.1)
         self.ppms.setField(end_field, scan_rate)
-        time.sleep(0.01)
+        self.profiler.sleep(0.01)
         _,field,status = self.ppms.getField()
         while np.abs(field - end_field) > 1 or status != 4:
             try:
@@ -162,22 +255,97 @@ class AHE():
                 # The response will typically be a comma-separated string, e.g., "X,Y"
                 real_part, imaginary_part = response.split(',')
                 voltage,voltage_y =map(float,[real_part,imaginary_part])
+                t = time.monotonic()
                 _,field,status = self.ppms.getField()
-                self.fields.append(field)
-                self.voltages.append(voltage)
-                self.voltages_y.append(voltage_y)
-                time.sleep(0.0005)
-                plt.pause(0.0005)
+                self.record(t=t,field=field,x=voltage,y=voltage_y)
+                if self.stop_early(field,scan_rate):
+                    break
+                if self.autorange is not None:
+                    self.autorange.check(t,voltage,voltage_y)
+                    self.profiler.sleep(1/sample_rate)
+                else:
+                    self.profiler.sleep(0.0005)
             except Exception as e:
+                self.error = e
                 print(f"Error during data collection: {e}")
                 break
 
-        df = pd.DataFrame({'field (Oe)':self.fields,'voltage_x (V)':self.voltages,'voltage_y (V)':self.voltages_y})        
-        df.to_csv(self.path_name + self.file_name + '.csv')
-        plt.savefig(self.path_name + self.file_name + '.png', dpi=300)
+        self.writer.flush()
+        self.plotter.save(self.path_name + self.file_name + '.png', dpi=300)
+
+    def scan_field_pipelined(self,legs,first,scan_rate,buffered,sample_rate,detector=None,fast_rate=None):
+        # all legs from `first` on in one acquisition: PPMS polling and lock-in reads
+        # run in their own threads, every lock-in sample is placed on the field axis
+        # from its timestamp, and the field turns around as soon as it reaches an
+        # end, without settling in between. With a detector the ramp runs at
+        # fast_rate except near the resonance.
+        print('start to scan field (pipelined, {} legs)'.format(len(legs)-first))
+        self.profiler.sleep(0.1)
+        read,drain = acquisition.sweep_reader(self.sr830,buffered,sample_rate,
+                                              zigzag_sweep.duration(legs[first:],scan_rate)+30,self.autorange)
+        pipeline = acquisition.Pipeline(self.ppms.getField,read)
+        pipeline.start()
+        stopped = False
+        for self.leg in range(first,len(legs)):
+            ini_field,end_field = legs[self.leg]
+            self.target = (end_field,scan_rate,zigzag_sweep.duration(legs[self.leg+1:],scan_rate))
+            if self.sweep is not None:
+                self.sweep.start(time.monotonic(),ini_field,end_field)
+            slow = detector is None or detector.slow(pipeline.value)
+            self.ppms.setField(end_field, scan_rate if slow else fast_rate)
+            self.profiler.sleep(0.01)
+            while np.abs(pipeline.value - end_field) > 1 or pipeline.status != 4:
+                if pipeline.error is not None:
+                    break
+                t,fields,x,y = pipeline.collect()
+                self.record(t=t,field=fields,x=x,y=y)
+                if self.stop_early(pipeline.value,scan_rate):
+                    stopped = True
+                    break
+                if detector is not None:
+                    detector.add(fields,x,y)
+                    # the field moves about fast_rate*1 s before a new rate takes effect
+                    if detector.slow(pipeline.value,lookahead=fast_rate) != slow:
+                        slow = not slow
+                        print('field {:.0f} Oe: ramp at {} Oe/s'.format(pipeline.value,scan_rate if slow else fast_rate))
+                        self.ppms.setField(end_field, scan_rate if slow else fast_rate)
+                self.profiler.sleep(0.2)
+            if pipeline.error is not None:
+                self.error = pipeline.error
+                print(f"Error during data collection: {pipeline.error}")
+                break
+            if stopped:
+                break
+        pipeline.stop()
+        if drain is not None:
+            pipeline.add(*drain())
+        t,fields,x,y = pipeline.collect(final=True)
+        self.record(t=t,field=fields,x=x,y=y)
+        self.writer.flush()
+        print('{} points collected'.format(self.writer.n_written))
+
+        self.plotter.save(self.path_name + self.file_name + '.png', dpi=300)
+
+    def record(self,**columns):
+        # keep the new samples and hand them on to the writer, the plotter and the fit
+        block = acquisition.record(self,'field',columns)
+        if self.fitter is not None:
+            with self.profiler.phase('fit'):
+                if self.fitter.add(block['field'],block['x']):
+                    self.plotter.fit(0,self.fitter.curves())
+                    self.plotter.title(self.fitter.text())
 
+    def stop_early(self,field,scan_rate):
+        # both resonances fitted to the early_stop tolerance: hold the field here
+        if self.early_stop is None or not self.fitter.done(self.early_stop):
+            return False
+        print('fit converged at {:.0f} Oe, stopping the sweep'.format(field))
+        self.ppms.setField(field,scan_rate)
+        return True
 
 def end_mearsument():
+    import pyvisa
+    from labdrivers.quantumdesign import qdinstrument
     ppms=qdinstrument.QdInstrument('DynaCool','192.168.0.4')
     ppms.setTemperature(300,12)
     ppms.setField(0)
@@ -191,6 +359,8 @@ def end_mearsument():
     # ppms.setPosition(0,1)
 
 if __name__ == "__main__":
+    os.chdir(sys.path[0])
+    from labdrivers.quantumdesign import qdinstrument
     ppms0 = qdinstrument.QdInstrument('DynaCool','192.168.0.4')
     for i in range(300,295,-10):  
         AHE(path_name='./SP/varing_vicinal/',
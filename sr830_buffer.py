@@ -0,0 +1,95 @@
+import time
+import numpy as np
+
+# SR830 internal data buffer: SRAT i samples at 2**(i-4) Hz (62.5 mHz ... 512 Hz)
+SAMPLE_RATES = [2.0**(i-4) for i in range(14)]
+BUFFER_SIZE = 16383 # points per channel
+
+def rate_index(rate):
+    # fastest SRAT setting not above the requested rate
+    index = 0
+    for i,r in enumerate(SAMPLE_RATES):
+        if r <= rate:
+            index = i
+    return index
+
+class SR830Buffer():
+    def __init__(self,sr830,rate=64):
+        self.sr830 = sr830
+        self.index = rate_index(rate)
+        self.rate = SAMPLE_RATES[self.index]
+        self.t0 = None
+        self.count = 0 # points already transferred
+
+    @classmethod
+    def for_duration(cls,sr830,duration,rate=64):
+        # lower the rate if the buffer would fill before the ramp ends
+        return cls(sr830,min(rate,BUFFER_SIZE/duration))
+
+    def arm(self):
+        self.sr830.write("DDEF 1,0,0") # CH1 = X
+        self.sr830.write("DDEF 2,0,0") # CH2 = Y
+        self.sr830.write("FAST 0")
+        self.sr830.write("SRAT {}".format(self.index))
+        self.sr830.write("SEND 0") # one shot, stop when full
+        self.sr830.write("TSTR 0")
+        self.sr830.write("REST")
+        self.count = 0
+
+    def start(self):
+        self.sr830.write("STRT")
+        self.t0 = time.monotonic()
+
+    def pause(self):
+        self.sr830.write("PAUS")
+
+    def available(self):
+        return int(self.sr830.query("SPTS?"))
+
+    def read_trace(self,channel,start,n):
+        # TRCB? returns n little-endian IEEE floats without header
+        return self.sr830.query_binary_values('TRCB? {},{},{}'.format(channel,start,n),
+                                              datatype='f',is_big_endian=False,header_fmt='empty',
+                                              expect_termination=False,data_points=n,container=np.array)
+
+    def fetch(self,max_points=4096):
+        n = min(self.available()-self.count,max_points)
+        if n <= 0:
+            return np.empty(0),np.empty(0),np.empty(0)
+        x = self.read_trace(1,self.count,n)
+        y = self.read_trace(2,self.count,n)
+        t = self.t0 + (self.count+np.arange(n))/self.rate
+        self.count += n
+        return t,x,y
+
+    def fetch_all(self):
+        t,x,y = [],[],[]
+        while True:
+            t1,x1,y1 = self.fetch()
+            if len(t1) == 0:
+                break
+            t.append(t1)
+            x.append(x1)
+            y.append(y1)
+        if not t:
+            return np.empty(0),np.empty(0),np.empty(0)
+        return np.concatenate(t),np.concatenate(x),np.concatenate(y)
+
+class AxisLog():
+    # timestamped PPMS readings used to place buffered samples on the field/angle axis
+    def __init__(self):
+        self.t = []
+        self.values = []
+
+    def poll(self,getter):
+        t_a = time.monotonic()
+        _,value,status = getter()
+        self.t.append((t_a+time.monotonic())/2)
+        self.values.append(value)
+        return value,status
+
+    def last_time(self):
+        return self.t[-1] if self.t else -np.inf
+
+    def place(self,t):
+        return np.interp(t,self.t,self.values)
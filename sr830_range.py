@@ -0,0 +1,125 @@
+import time
+import numpy as np
+
+# SR830 range management. SENS i sets the full scale (2 nV ... 1 V in 1-2-5
+# steps), OFLT i the time constant (10 us ... 30 ks in 1-3 steps) and OFSL i the
+# filter slope (6, 12, 18, 24 dB/oct). AutoRange polls the latched overload bits
+# (LIAS?) together with the newest samples, steps the sensitivity when the signal
+# overloads (a decade up) or sits far below full scale for a while (down to where
+# it fills about half of it), and discards the samples taken while the output
+# settles after a change. Every kept sample is tagged with its full scale.
+#
+#   self.autorange = sr830_range.AutoRange(self.sr830)
+#   read = self.autorange.reader(acquisition.buffer_reader(buffer))
+
+SENSITIVITIES = [m*10.0**e for e in range(-9,1) for m in (2,5,10)][:27] # V (or A x 1e6 for I input)
+TIME_CONSTANTS = [m*10.0**e for e in range(-5,5) for m in (1,3)] # s
+SLOPES = [6,12,18,24] # dB/oct
+SETTLE = [5,7,9,10] # time constants to settle within 1 %, per slope
+ENBW = [1/4,1/8,3/32,5/64] # equivalent noise bandwidth x time constant, per slope
+OVERLOAD = 0b111 # LIAS? bits 0-2: input (reserve), filter, output overload
+
+def sensitivity_index(full_scale):
+    # most sensitive range that still holds full_scale
+    return min(int(np.searchsorted(SENSITIVITIES,full_scale*(1-1e-9))),len(SENSITIVITIES)-1)
+
+def independent_rate(tau,slope=1):
+    # two samples per noise bandwidth; sampling faster only repeats correlated points
+    return 2*ENBW[slope]/tau
+
+class AutoRange():
+    def __init__(self,sr830,high=0.9,low=0.1,target=0.5,hold=3,min_index=0,max_index=26,interval=0.5):
+        self.sr830 = sr830
+        self.high = high # range up above this fraction of full scale
+        self.low = low # range down below this fraction of full scale ...
+        self.hold = hold # ... for this many seconds
+        self.target = target # fraction of full scale the new range is chosen for
+        self.min_index = min_index
+        self.max_index = max_index
+        self.interval = interval # s between LIAS? polls
+        self.index = int(self.sr830.query('SENS?'))
+        self.tau = TIME_CONSTANTS[int(self.sr830.query('OFLT?'))]
+        self.slope = min(int(self.sr830.query('OFSL?')),len(SLOPES)-1)
+        self.sr830.query('LIAS?') # clear the latched bits
+        # (time of the change, SENS index, time the output has settled)
+        self.changes = [(-np.inf,self.index,-np.inf)]
+        self.last_check = -np.inf
+        self.peak = 0.0 # largest |X|,|Y| since the last poll
+        self.quiet_peak = 0.0 # largest |X|,|Y| since the signal fell below low
+        self.quiet_since = None
+
+    @property
+    def full_scale(self):
+        return SENSITIVITIES[self.index]
+
+    def settle_time(self):
+        return SETTLE[self.slope]*self.tau
+
+    def sample_rate(self):
+        return independent_rate(self.tau,self.slope)
+
+    def check(self,t,x,y):
+        # samples just read; polls LIAS? at most every interval s and returns
+        # True when the range was changed
+        t = np.atleast_1d(t)
+        settled = t >= self.changes[-1][2]
+        if settled.any():
+            self.peak = max(self.peak,np.abs(np.atleast_1d(x)[settled]).max(),np.abs(np.atleast_1d(y)[settled]).max())
+        now = time.monotonic()
+        if now-self.last_check < self.interval or now < self.changes[-1][2]:
+            return False
+        self.last_check = now
+        status = int(self.sr830.query('LIAS?'))
+        peak,self.peak = self.peak,0.0
+        if status & OVERLOAD:
+            # the reading is clipped, its size unknown
+            index = self.index+3
+        elif peak > self.high*self.full_scale:
+            index = sensitivity_index(peak/self.target)
+        elif 0 < peak < self.low*self.full_scale:
+            if self.quiet_since is None:
+                self.quiet_since,self.quiet_peak = now,0.0
+            self.quiet_peak = max(self.quiet_peak,peak)
+            if now-self.quiet_since < self.hold:
+                return False
+            index = sensitivity_index(self.quiet_peak/self.target)
+        else:
+            self.quiet_since = None
+            return False
+        self.quiet_since = None
+        index = min(max(index,self.min_index),self.max_index)
+        if index == self.index:
+            return False
+        self.set_sensitivity(index,now)
+        return True
+
+    def set_sensitivity(self,index,now=None):
+        now = time.monotonic() if now is None else now
+        self.sr830.write('SENS {}'.format(index))
+        print('SR830 sensitivity {:.0e} V -> {:.0e} V'.format(self.full_scale,SENSITIVITIES[index]))
+        self.index = index
+        self.changes.append((now,index,now+self.settle_time()))
+
+    def reader(self,read):
+        # wraps an acquisition reader so that the checks run in its thread,
+        # between its own SR830 reads
+        def checked():
+            t,x,y = read()
+            if len(t):
+                self.check(t,x,y)
+            return t,x,y
+        return checked
+
+    def settled(self,t):
+        # False for samples taken between a range change and the output settling
+        t = np.atleast_1d(t)
+        changes = list(self.changes)
+        i = np.searchsorted([c[0] for c in changes],t,side='right')-1
+        return t >= np.array([c[2] for c in changes])[i]
+
+    def tag(self,t):
+        # full scale (V) each sample was taken at
+        t = np.atleast_1d(t)
+        changes = list(self.changes)
+        i = np.searchsorted([c[0] for c in changes],t,side='right')-1
+        return np.array(SENSITIVITIES)[np.array([c[1] for c in changes])[i]]
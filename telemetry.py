@@ -0,0 +1,90 @@
+import threading
+import time
+import numpy as np
+
+# Environment of the sample over a whole run: a background thread reads
+# temperature, field, position and chamber status from the PPMS every interval s
+# (slow, off the acquisition path), and at write time every sample gets the
+# readings interpolated to its time stamp. Samples past the newest reading get
+# that reading. The chamber status is a code and is held, not interpolated.
+#
+#   self.telemetry = telemetry_sampler.open_telemetry(telemetry,self.ppms)
+#   columns.update(self.telemetry.place(t))
+
+# channel -> PPMS getter
+GETTERS = {'temperature':'getTemperature','field':'getField','position':'getPosition','chamber':'getChamber'}
+# channel -> data file column
+COLUMNS = {'temperature':'temperature (K)','field':'field (Oe)','position':'position (degree)','chamber':'chamber'}
+
+class Telemetry(threading.Thread):
+    def __init__(self,ppms,channels=('temperature','field','position','chamber'),interval=1.0):
+        super().__init__(daemon=True)
+        self.ppms = ppms
+        self.channels = list(channels)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.t = {c:[] for c in self.channels}
+        self.values = {c:[] for c in self.channels}
+        self.errors = 0
+        self.stopped = threading.Event()
+
+    def poll(self):
+        for channel in self.channels:
+            t_a = time.monotonic()
+            try:
+                result = getattr(self.ppms,GETTERS[channel])()
+            except Exception:
+                # a missed reading only leaves a longer gap to interpolate over
+                self.errors += 1
+                continue
+            # (err, value, status), the chamber only has a status
+            value = result[-1] if channel == 'chamber' else result[1]
+            with self.lock:
+                self.t[channel].append((t_a+time.monotonic())/2)
+                self.values[channel].append(value)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.poll()
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        # first reading before any sample
+        self.poll()
+        super().start()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.stop()
+
+    def place(self,t):
+        # channel -> readings at the sample times t (NaN without readings)
+        t = np.atleast_1d(t)
+        placed = {}
+        with self.lock:
+            for channel in self.channels:
+                ts,values = self.t[channel],self.values[channel]
+                if not ts:
+                    placed[channel] = np.full(len(t),np.nan)
+                elif channel == 'chamber':
+                    i = np.maximum(np.searchsorted(ts,t,side='right')-1,0)
+                    placed[channel] = np.array(values,dtype=float)[i]
+                else:
+                    placed[channel] = np.interp(t,ts,values)
+        return placed
+
+def open_telemetry(telemetry,ppms,axes=()):
+    # telemetry argument of the measurement classes: True for a reading every
+    # second, a number for the interval in s, False/None for none; axes: the
+    # channels the measurement reads itself at full rate
+    if telemetry is None or telemetry is False:
+        return None
+    interval = 1.0 if telemetry is True else telemetry
+    return Telemetry(ppms,[c for c in GETTERS if c not in axes],interval)
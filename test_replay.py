@@ -0,0 +1,45 @@
+import os
+import threading
+import pytest
+import simulated
+import replay
+import spin_pumping
+
+# Replays of recorded runs against the simulated instruments:
+#   python -m pytest -q test_replay.py
+
+def sweep(path,file_name,session):
+    return spin_pumping.AHE(path_name=path,file_name=file_name,frequency=5,temperature0=300,field0=300,scan_rate=20,
+                            harm=1,set_temp=False,waiting_time=0,headless=True,session=session,threaded=True,catalog=False)
+
+def test_threaded_replay_finishes(tmp_path):
+    path = str(tmp_path)+os.sep
+    ppms = simulated.SimPPMS(speedup=50,settle_time=0)
+    recorder = replay.Recorder(path+'run.jsonl')
+    recorded = sweep(path,'recorded_',recorder.session(ppms=ppms,rm=simulated.SimResourceManager(ppms,latency=0.002)))
+    recorder.close()
+
+    replayer = replay.Replayer(path+'run.jsonl',realtime=False)
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(run=sweep(path,'replayed_',replayer.session())),daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), replayer.report()
+    assert result['run'].writer.n_written > 0
+    # the pollers may ask more often than recorded, but not without bound
+    assert replayer.repeated < replayer.replayed-replayer.repeated, replayer.report()
+    assert recorded.writer.n_written > 0
+
+def test_exhausted_query_raises(tmp_path):
+    path = str(tmp_path)+os.sep
+    ppms = simulated.SimPPMS()
+    recorder = replay.Recorder(path+'run.jsonl')
+    recorder.session(ppms=ppms,rm=simulated.SimResourceManager(ppms)).ppms.getField()
+    recorder.close()
+
+    replayer = replay.Replayer(path+'run.jsonl',realtime=False,max_repeats=3)
+    ppms = replayer.session().ppms
+    for _ in range(4):
+        ppms.getField()
+    with pytest.raises(LookupError):
+        ppms.getField()
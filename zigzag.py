@@ -0,0 +1,33 @@
+import numpy as np
+
+# Continuous zig-zag sweeps: start -> end -> start ... for a number of cycles,
+# with the ramp turned around at each end as soon as it arrives (no settle, no
+# pause) while the acquisition keeps running. Every sample is tagged with the
+# direction (+1/-1) of the leg it was taken on and the cycle index, for
+# hysteresis loops and averaging over cycles.
+
+def legs(start,end,cycles=1):
+    # one cycle is the leg out and the leg back
+    return [(start,end) if i % 2 == 0 else (end,start) for i in range(2*cycles)]
+
+def duration(legs,rate):
+    return sum(np.abs(b-a) for a,b in legs)/rate
+
+class SweepLog():
+    # start time and direction of each leg; first: index of the first leg (resume)
+    def __init__(self,first=0):
+        self.first = first
+        self.starts = []
+        self.directions = []
+
+    def start(self,t,ini,end):
+        self.starts.append(t)
+        self.directions.append(np.sign(end-ini))
+
+    def tag(self,t):
+        # (direction, cycle) of each sample from the leg running when it was taken
+        t = np.atleast_1d(t)
+        if not self.starts:
+            return np.full(len(t),np.nan),np.full(len(t),np.nan)
+        i = np.maximum(np.searchsorted(self.starts,t,side='right')-1,0)
+        return np.array(self.directions)[i],(self.first+i)//2